@@ -1,11 +1,41 @@
 import numpy as np
 import pandas as pd
+import io
+import re
 import sqlite3
 import os
+import shlex
+import shutil
 import subprocess
-from pybedtools import BedTool
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
 from collections import defaultdict
 from enum import Enum, auto
+from .cache import file_digest
+from .gnomad import build_gnomad_index, load_gnomad_index, match_gnomad
+from .hgmd import connect_hgmd_read_only
+from .overlap import infer_like_read_csv, pad_zero_length, reciprocal_overlap_join
+
+REFERENCE_VERSION = 2 #increment when the gene reference annotations change, to invalidate reference bundles
+
+# grouped HGMD rows of the genes queried so far, by HGMD database file and modification time
+hgmd_gene_cache = {}
+# exon indexes built by SVAnnotator.exon_index, by exon BED file and modification time
+exon_index_cache = {}
+# gnomAD-SV indexes and the chromosomes read in to them so far, by gnomAD-SV file and modification time
+gnomad_index_cache = {}
+# parsed biomart, omim, exac and hpo files of the gene reference annotations, by reader, file and modification time
+reference_frame_cache = {}
+# population count databases read by SVAnnotator.annotate_counts_batch, by file and modification time
+counts_cache = {}
+# AnnotSV header and output lines of the SVs annotated so far, by AnnotSV version
+annotsv_lines_cache = {}
+
+OMIM_INHERITANCE_CODES = [("Autosomal dominant", "AD"), ("Autosomal recessive", "AR"), ("X-linked dominant", "XLD"), ("X-linked recessive", "XLR"), \
+    ("Y-linked dominant", "YLD"), ("Y-linked recessive", "YLR"), ("X-linked", "XL"), ("Y-linked", "YL")]
+# one optional lookahead per inheritance, so that each is found anywhere in a phenotype even when they overlap (ex. 'X-linked recessive' is XLR and XL)
+OMIM_INHERITANCE_REGEX = re.compile(''.join('(?:(?=.*?(?P<%s>%s)))?' % (code, re.escape(description)) for description, code in OMIM_INHERITANCE_CODES), re.IGNORECASE | re.DOTALL)
 
 class SVTYPE(Enum):
     def _generate_next_value_(name, start, count, last_values):
@@ -19,26 +49,123 @@ class SVTYPE(Enum):
     TRA = auto()
 
 class SVAnnotator:
-    def __init__(self, exon_bed, hgmd_db, hpo, exac, omim, biomart):
+    def __init__(self, exon_bed, hgmd_db, hpo, exac, omim, biomart, reference_bundle=None, threads=1):
+        '''
+            With a reference_bundle, the gene reference annotations of the exac, omim and biomart files, which are the same for every family, are loaded
+            from it when it was built from the current files. Otherwise they are built from those files, parsed in up to threads worker processes,
+            then saved to the bundle for the next run. The HPO terms of the family in hpo are then joined to them
+        '''
+        if reference_bundle is None:
+            self.make_gene_reference(exac, omim, biomart, threads=threads)
+        else:
+            sources = self.reference_sources(exac, omim, biomart)
+            if self.load_reference(reference_bundle, sources):
+                print('Using gene reference annotations from %s' % reference_bundle)
+            else:
+                self.make_gene_reference(exac, omim, biomart, threads=threads)
+                self.save_reference(reference_bundle, sources)
+
+        self.set_hpo(hpo)
 
-        self.make_gene_ref_df(biomart)
+    def make_gene_reference(self, exac, omim, biomart, threads=1):
+        '''
+            Build the gene reference annotations shared by all families, from the biomart, omim and exac files, in to base_gene_ref_df.
+            With threads > 1 the files are parsed concurrently in worker processes, then joined in order.
+            Parsed files are kept in reference_frame_cache, so rebuilding in the same process does not parse them again
+        '''
+        readers = [(self.read_biomart, biomart), (self.read_omim, omim), (self.read_exac, exac)]
+        cache_keys = [(reader.__name__, os.path.abspath(path), os.stat(path).st_mtime_ns) for reader, path in readers]
+        missing = [(reader, path, cache_key) for (reader, path), cache_key in zip(readers, cache_keys) if cache_key not in reference_frame_cache]
+
+        if threads > 1 and len(missing) > 1:
+            with ProcessPoolExecutor(max_workers=min(threads, len(missing))) as pool:
+                futures = [pool.submit(reader, path) for reader, path, cache_key in missing]
+                reference_frame_cache.update((cache_key, future.result()) for (reader, path, cache_key), future in zip(missing, futures))
+        else:
+            reference_frame_cache.update((cache_key, reader(path)) for reader, path, cache_key in missing)
+        biomart_df, omim_df, exac_df = [reference_frame_cache[cache_key] for cache_key in cache_keys]
 
-        if os.path.isfile(hpo):
+        self.make_gene_ref_df(biomart, biomart_df)
+        print('Annotating genes with OMIM phenotypes and inheritance patterns')
+        self.annotate_omim(omim, omim_df)
+        print('Annotating genes with ExAC transcript probabilities')
+        self.annotate_exac(exac, exac_df)
+        self.base_gene_ref_df = self.gene_ref_df
+
+    def set_hpo(self, hpo):
+        '''
+            Join the HPO terms of a family in hpo to base_gene_ref_df, making gene_ref_df. Without a valid hpo file HPO annotations are skipped.
+            Nothing is done if gene_ref_df already has the terms of the same, unchanged hpo file
+        '''
+        hpo_source = ('read_hpo', os.path.abspath(hpo), os.stat(hpo).st_mtime_ns) if hpo and os.path.isfile(hpo) else None
+        if getattr(self, 'hpo_source', False) == hpo_source: # False before the first call
+            return
+
+        self.gene_ref_df = self.base_gene_ref_df
+        self.hpo_source = hpo_source
+
+        if hpo_source is not None:
             print('Annotating genes with HPO terms')
             self.HPO = True
-            self.annotate_hpo(hpo)
+            if hpo_source not in reference_frame_cache:
+                reference_frame_cache[hpo_source] = self.read_hpo(hpo)
+            self.annotate_hpo(hpo, reference_frame_cache[hpo_source])
         else:
             print('No valid HPO file specified. Skipping annotation.')
             self.HPO = False
 
-        print('Annotating genes with OMIM phenotypes and inheritance patterns')
-        self.annotate_omim(omim)
-        print('Annotating genes with ExAC transcript probabilities')
-        self.annotate_exac(exac)
-
         # technical note: drop duplicates before setting index - doing the reverse order will drop all duplicated columns instead of keeping one copy
         self.gene_ref_df = self.gene_ref_df.drop_duplicates(keep='first').set_index('BioMart Ensembl Gene ID').astype(str)
 
+    def reference_sources(self, exac, omim, biomart):
+        '''
+            Identify the source files of the gene reference annotations by path, size, modification time and SHA-256 of their content
+        '''
+        sources = {}
+        for name, path in ('exac', exac), ('omim', omim), ('biomart', biomart):
+            if path and os.path.isfile(path):
+                stat = os.stat(path)
+                sources[name] = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns, file_digest(path))
+            else:
+                sources[name] = None
+        return sources
+
+    def load_reference(self, reference_bundle, sources):
+        '''
+            Load the gene reference annotations shared by all families from reference_bundle, returns False if it does not exist, cannot be read
+            or was built by another version of SVAnnotator or from other source files
+        '''
+        try:
+            bundle = pd.read_pickle(reference_bundle)
+        except FileNotFoundError:
+            return False
+        except Exception as e: # corrupt bundle, or pickled by a version of the code that no longer loads it
+            print('Gene reference annotations in %s cannot be read, rebuilding: %r' % (reference_bundle, e))
+            return False
+
+        if not isinstance(bundle, dict) or bundle.get('version') != REFERENCE_VERSION or bundle.get('sources') != sources:
+            print('Gene reference annotations in %s are out of date, rebuilding' % reference_bundle)
+            return False
+
+        self.base_gene_ref_df = bundle['gene_ref_df']
+        return True
+
+    def save_reference(self, reference_bundle, sources):
+        '''
+            Save the gene reference annotations shared by all families to reference_bundle with the sources they were built from. The file is replaced atomically
+        '''
+        bundle = {'version': REFERENCE_VERSION, 'sources': sources, 'gene_ref_df': self.base_gene_ref_df}
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(reference_bundle)), suffix='.tmp')
+        os.close(fd)
+        try:
+            pd.to_pickle(bundle, tmp_path)
+            os.chmod(tmp_path, 0o644) #mkstemp makes the file readable by its owner only, the bundle is shared by all families
+            os.replace(tmp_path, reference_bundle)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
     def set_column_values(self, df, annotation_dict, column_name):
         for interval, data in annotation_dict.items():
             df.loc[interval, column_name] = data
@@ -84,56 +211,107 @@ class SVAnnotator:
 
         return col.apply(translate)
 
+    def exon_index(self, exon_bed):
+        '''
+            Index exon_bed by chromosome for calc_exons_spanned and calc_exon_boundaries. Built once per exon BED and modification time, and shared
+
+            For each chromosome:
+                'starts', 'ends': sorted exon starts and ends, zero-length exons padded by one base on each side like bedtools does
+                'boundaries': sorted unique exon boundaries (starts and ends)
+                'first_seen': position of the first listing of each boundary, all exon starts listed before all exon ends
+                'genes': gene of the first exon listed with each boundary
+        '''
+        cache_key = (os.path.abspath(exon_bed), os.stat(exon_bed).st_mtime_ns)
+        if cache_key in exon_index_cache:
+            return exon_index_cache[cache_key]
+
+        exons = pd.read_csv(exon_bed, sep='\t', names=['CHROM', 'POS', 'END', 'GENE'], dtype={'CHROM': str})
+        exon_starts, exon_ends = pad_zero_length(exons['POS'].values, exons['END'].values)
+        #make single column containing all exon boundaries
+        boundaries = pd.melt(exons, id_vars=['CHROM', 'GENE'], value_vars=['POS', 'END'])
+        boundaries['order'] = np.arange(len(boundaries))
+        #keep the first listing of each boundary, which decides ties and the gene of the boundary
+        boundaries = boundaries.drop_duplicates(subset=['CHROM', 'value']).sort_values(['CHROM', 'value'], kind='mergesort')
+
+        index = {}
+        for chrom, rows in exons.groupby('CHROM', sort=False).indices.items():
+            index[chrom] = {'starts': np.sort(exon_starts[rows]), 'ends': np.sort(exon_ends[rows])}
+        for chrom, chrom_boundaries in boundaries.groupby('CHROM', sort=False):
+            index[chrom].update(boundaries=chrom_boundaries['value'].values.astype(np.int64), first_seen=chrom_boundaries['order'].values, genes=chrom_boundaries['GENE'].values.astype(str))
+
+        exon_index_cache[cache_key] = index
+        return index
+
     def calc_exons_spanned(self, sample_df, exon_bed):
+        '''
+            Count the exons overlapped by each SV, like bedtools intersect. An exon overlaps an SV if it starts before the SV ends and ends after the SV starts.
+            Exons that end at or before the start of the SV also start before its end, so the count is the number of exon starts before the SV end minus
+            the number of exon ends at or before the SV start, two np.searchsorted lookups on the sorted arrays of exon_index
+        '''
+        return sample_df.assign(EXONS_SPANNED=self.exons_spanned(sample_df.index, exon_bed)['EXONS_SPANNED'].values)
+
+    def exons_spanned(self, sv_index, exon_bed):
+        '''
+            Frame of the EXONS_SPANNED of the SVs in sv_index, see calc_exons_spanned
+        '''
         print('Calculating the number of exons affected by each structural variant ...')
 
-        exon_counts = defaultdict(int) #incrementing dict and setting value in df is faster than incrementing values in the df
-        exon_ref = BedTool(exon_bed)
-        sample_bedtool = BedTool(list(sample_df.reset_index()[['CHROM', 'POS', 'END', 'SVTYPE']].values))
+        index = self.exon_index(exon_bed)
+        sv = sv_index.to_frame(index=False)
+        starts, ends = pad_zero_length(sv['POS'].values.astype(np.int64), sv['END'].values.astype(np.int64))
+        chroms = sv['CHROM'].astype(str).values
+        exon_counts = np.zeros(len(sv), dtype=np.int64)
 
-        for interval in sample_bedtool.intersect(exon_ref, wa=True):
-            exon_counts[(str(interval.chrom), str(interval.start), str(interval.stop),  str(interval[3]))] += 1
-        
-        count_df = pd.Series(exon_counts).to_frame().astype(str)
-        count_df.index.names = ['CHROM', 'POS', 'END', 'SVTYPE']
-        count_df.columns = ['EXONS_SPANNED']
+        for chrom in np.unique(chroms):
+            if chrom not in index:
+                continue
+            rows = np.flatnonzero(chroms == chrom)
+            exon_counts[rows] = np.searchsorted(index[chrom]['starts'], ends[rows], side='left') - np.searchsorted(index[chrom]['ends'], starts[rows], side='right')
 
-        return sample_df.join(count_df).fillna(value={'EXONS_SPANNED': 0})
+        return pd.DataFrame({'EXONS_SPANNED': exon_counts}, index=sv_index)
 
     def calc_exon_boundaries(self, sample_df, exon_bed):
+        '''
+            Find the exon boundary closest to each breakpoint of the SVs. The distance is the boundary minus the breakpoint plus one to account for 1-based coordinates.
+            When two boundaries are equally close, the one first listed in exon_bed (all exon starts, then all exon ends) is chosen, and the gene of a boundary
+            is that of the first exon listed with it, like find_min_distance
+
+            Implementation:
+                The boundaries of each chromosome are sorted once by exon_index, then all breakpoints on the chromosome are located among them in one batch with np.searchsorted.
+                The nearest boundary is one of the two neighbours of the insertion point
+        '''
         print('Calculating exon boundaries closest to structural variant breakpoints ...')
 
-        def find_min_distance(position, boundaries):
-            #range is boundary minus position of breakpoint plus one to account for 1-based coordinates
-            distance = {((boundary-position) + 1):boundary for boundary in boundaries['value'].tolist()}
-            min_distance = min(distance, key=abs)
-            min_boundary = distance[min_distance]
-            gene = boundaries[boundaries['value'] == min_boundary]['GENE'].values[0]
-            return min_distance, min_boundary, gene
-            
-        exons = pd.read_csv(exon_bed, sep='\t', names=['CHROM', 'POS', 'END', 'GENE'])
-        #make single column containing all exon boundaries
-        exons = pd.melt(exons, id_vars=['CHROM', 'GENE'], value_vars=['POS', 'END'])
-
-        boundary_distances = defaultdict()
-        boundary_distances['left'] = {'nearest_boundary':[],'nearest_distance':[]}
-        boundary_distances['right'] = {'nearest_boundary':[],'nearest_distance':[]}
-
-        for index,row in sample_df.iterrows():
-            chr, pos, end = str(row['CHROM']), int(row['POS']), int(row['END'])
-            print(chr, pos, end)
-            boundaries = exons[exons['CHROM'] == chr]
-            if len(boundaries) != 0:
-                for breakpoint in 'left', 'right':
-                    position = pos if breakpoint == 'left' else end
-                    min_distance, min_boundary, gene = find_min_distance(position, boundaries)
-                    boundary_distances[breakpoint]['nearest_boundary'].append(gene + '|' + str(min_boundary))
-                    boundary_distances[breakpoint]['nearest_distance'].append(min_distance)
-            else:
-                for breakpoint in 'left', 'right':
-                    # for non-canonical chromosomes or MT
-                    boundary_distances[breakpoint]['nearest_boundary'].append('.')
-                    boundary_distances[breakpoint]['nearest_distance'].append('.')
+        def find_min_distances(positions, boundaries, first_seen, genes):
+            targets = positions - 1
+            right = np.searchsorted(boundaries, targets, side='left')
+            left = right - 1
+            right = np.minimum(right, len(boundaries) - 1)
+            left = np.maximum(left, 0)
+
+            left_distance = targets - boundaries[left]
+            right_distance = boundaries[right] - targets
+            use_left = (left_distance < right_distance) | ((left_distance == right_distance) & (first_seen[left] < first_seen[right]))
+            # a breakpoint past the last boundary only has a left neighbour, before the first boundary only a right one
+            use_left = np.where(boundaries[right] < targets, True, np.where(boundaries[left] > targets, False, use_left))
+            nearest = np.where(use_left, left, right)
+
+            return boundaries[nearest] - targets, boundaries[nearest], genes[nearest]
+
+        boundary_distances = {breakpoint: {'nearest_boundary': np.full(len(sample_df), '.', dtype=object), 'nearest_distance': np.full(len(sample_df), '.', dtype=object)} for breakpoint in ('left', 'right')}
+        chroms = sample_df['CHROM'].astype(str).values
+
+        for chrom, exons in self.exon_index(exon_bed).items():
+            # non-canonical chromosomes or MT without exons keep '.'
+            rows = np.flatnonzero(chroms == chrom)
+            if len(rows) == 0:
+                continue
+            values, first_seen, genes = exons['boundaries'], exons['first_seen'], exons['genes']
+
+            for breakpoint, col in ('left', 'POS'), ('right', 'END'):
+                min_distance, min_boundary, gene = find_min_distances(sample_df[col].values[rows].astype(np.int64), values, first_seen, genes)
+                boundary_distances[breakpoint]['nearest_boundary'][rows] = [g + '|' + str(b) for g, b in zip(gene, min_boundary.tolist())]
+                boundary_distances[breakpoint]['nearest_distance'][rows] = min_distance.tolist()
 
         sample_df['nearestLeftExonBoundary'], sample_df['nearestLeftExonDistance'] = boundary_distances['left']['nearest_boundary'], boundary_distances['left']['nearest_distance']
         sample_df['nearestRightExonBoundary'],sample_df['nearestRightExonDistance'] = boundary_distances['right']['nearest_boundary'], boundary_distances['right']['nearest_distance']
@@ -141,6 +319,12 @@ class SVAnnotator:
         return(sample_df.set_index(['CHROM', 'POS', 'END', 'SVTYPE']))
 
 
+    def exon_boundaries(self, sv_index, exon_bed):
+        '''
+            Frame of the nearest exon boundaries of the SVs in sv_index, see calc_exon_boundaries
+        '''
+        return self.calc_exon_boundaries(sv_index.to_frame(index=False), exon_bed)
+
     def find_min_distance(self, position, boundaries):
         #range is boundary minus position of breakpoint plus one to account for 1-based coordinates
         distance = {((boundary-position) + 1):boundary for boundary in boundaries['value'].tolist()}
@@ -153,39 +337,53 @@ class SVAnnotator:
 
 
     def annotate_hgmd(self, hgmd, sv_record):
+        '''
+            Join the published pathogenic deletions, insertions and duplications of HGMD on the gene names and SVTYPE of each SV
+        '''
+        return sv_record.join(self.hgmd_table(hgmd, sv_record['BioMart Associated Gene Name']), on=['BioMart Associated Gene Name', 'SVTYPE'], how='left')
+
+    def hgmd_table(self, hgmd, gene_names):
+        '''
+            HGMD deletions, insertions and duplications of the genes in gene_names, grouped per gene and indexed by gene name and SVTYPE
+
+            Implementation:
+                Only the HGMD rows of genes in the report are read: the gene names are loaded in to a temporary table that the queries filter on,
+                through the indexes on the gene columns made by crg.build_sv_reference.py -hgmd when the database has them. The grouped rows of each
+                gene are memoized in hgmd_gene_cache, so later reports in the same process only query the genes not seen before. The database is
+                opened read-only, so its modification time, which the memo is keyed on, does not change while reporting
+        '''
         print('Annotating genes with published cases of pathogenic structural variants from HGMD')
 
-        def get_hgmd_df():
-            conn = sqlite3.connect(hgmd)
+        def get_hgmd_df(genes):
+            conn = connect_hgmd_read_only(hgmd)
+
+            conn.execute('CREATE TEMP TABLE REPORT_GENES (gene TEXT COLLATE NOCASE PRIMARY KEY)')
+            conn.executemany('INSERT INTO REPORT_GENES VALUES (?)', ((gene,) for gene in genes))
 
             gros_del = pd.read_sql_query('''
                 SELECT del.DISEASE, del.TAG, del.DESCR, del.gene,
                 printf('%s:%s:%s:%s', del.JOURNAL, del.AUTHOR, del.YEAR, del.PMID) AS JOURNAL_DETAILS,
                 ALLGENES.HGNCID
                 FROM GROSDEL as del 
-                LEFT JOIN ALLGENES ON ALLGENES.GENE=del.GENE;
+                LEFT JOIN ALLGENES ON ALLGENES.GENE=del.GENE
+                WHERE del.gene COLLATE NOCASE IN (SELECT gene FROM REPORT_GENES);
             ''', conn)
 
             gros_ins = pd.read_sql_query('''
                 SELECT ins.DISEASE, ins.TAG, ins.DESCR, ins.gene, 
                 printf('%s:%s:%s:%s', ins.JOURNAL, ins.AUTHOR, ins.YEAR, ins.PMID) AS JOURNAL_DETAILS,
-                ALLGENES.HGNCID
+                ALLGENES.HGNCID, ins.type
                 FROM GROSINS as ins 
                 LEFT JOIN ALLGENES ON ALLGENES.GENE=ins.GENE
-                WHERE ins.type='I';
-            ''', conn)
-
-            gros_dup = pd.read_sql_query('''
-                SELECT ins.DISEASE, ins.TAG, ins.DESCR, ins.gene, 
-                printf('%s:%s:%s:%s', ins.JOURNAL, ins.AUTHOR, ins.YEAR, ins.PMID) AS JOURNAL_DETAILS,
-                ALLGENES.HGNCID
-                FROM GROSINS as ins 
-                LEFT JOIN ALLGENES ON ALLGENES.GENE=ins.GENE
-                WHERE ins.type='D';
+                WHERE ins.gene COLLATE NOCASE IN (SELECT gene FROM REPORT_GENES) AND ins.type IN ('I', 'D');
             ''', conn)
             
             conn.close()
 
+            ins_type = gros_ins.pop('type')
+            gros_dup = gros_ins[ins_type == 'D'].copy()
+            gros_ins = gros_ins[ins_type == 'I'].copy()
+
             return gros_del, gros_ins, gros_dup
 
         def groupby_genes(df):
@@ -196,28 +394,44 @@ class SVAnnotator:
             df['hgncID'] = df['hgncID'].apply(lambda col: col.split(', ')[0])
             #df['omimid'] = df['omimid'].apply(lambda col: col.split(', ')[0])
             return df
-        
-        hgmd_sv_df = pd.DataFrame()
-        gros_del, gros_ins, gros_dup = get_hgmd_df()
 
-        gros_del = groupby_genes(gros_del)
-        gros_ins = groupby_genes(gros_ins)
-        gros_dup = groupby_genes(gros_dup)
+        # memoized per database file, invalidated when the file changes
+        cache_key = (os.path.abspath(hgmd), os.stat(hgmd).st_mtime_ns)
+        cache = hgmd_gene_cache.setdefault(cache_key, {'genes': set(), 'df': None})
+
+        genes = set(gene_names.dropna().astype(str).str.upper()) - cache['genes']
+        if genes or cache['df'] is None:
+            gros_del, gros_ins, gros_dup = get_hgmd_df(genes)
+
+            gros_del = groupby_genes(gros_del)
+            gros_ins = groupby_genes(gros_ins)
+            gros_dup = groupby_genes(gros_dup)
 
-        for df in [gros_del, gros_ins, gros_dup]:
-            df['gene'] = df['gene'].apply(lambda symbol: symbol.upper())
-            self.append_prefix_to_columns(df, 'HGMD')
+            for df in [gros_del, gros_ins, gros_dup]:
+                df['gene'] = df['gene'].apply(lambda symbol: symbol.upper())
+                self.append_prefix_to_columns(df, 'HGMD')
 
-        gros_del['HGMD SVTYPE'] = SVTYPE.DEL.value
-        gros_ins['HGMD SVTYPE'] = SVTYPE.INS.value
-        gros_dup['HGMD SVTYPE'] = SVTYPE.DUP.value
+            gros_del['HGMD SVTYPE'] = SVTYPE.DEL.value
+            gros_ins['HGMD SVTYPE'] = SVTYPE.INS.value
+            gros_dup['HGMD SVTYPE'] = SVTYPE.DUP.value
 
-        # hgmd_sv_df = hgmd_sv_df.rename(columns={'HGMD gene': 'Genes in HGMD'})
-        hgmd_sv_df = pd.concat([gros_del, gros_ins, gros_dup], ignore_index=True, sort=False)
-        hgmd_sv_df['Genes in HGMD'] = hgmd_sv_df['HGMD gene']
-        hgmd_sv_df = hgmd_sv_df.set_index(keys=['HGMD gene', 'HGMD SVTYPE']).astype(str)
+            # hgmd_sv_df = hgmd_sv_df.rename(columns={'HGMD gene': 'Genes in HGMD'})
+            hgmd_sv_df = pd.concat([gros_del, gros_ins, gros_dup], ignore_index=True, sort=False)
+            hgmd_sv_df['Genes in HGMD'] = hgmd_sv_df['HGMD gene']
+            hgmd_sv_df = hgmd_sv_df.set_index(keys=['HGMD gene', 'HGMD SVTYPE']).astype(str)
 
-        return sv_record.join(hgmd_sv_df, on=['BioMart Associated Gene Name', 'SVTYPE'], how='left')
+            cache['df'] = hgmd_sv_df if cache['df'] is None else pd.concat([cache['df'], hgmd_sv_df])
+            cache['genes'] |= genes
+
+        return cache['df']
+
+    def hgmd_annotations(self, hgmd, gene_annotations):
+        '''
+            Frame of the HGMD annotations of the SVs in gene_annotations, the frame returned by gene_annotations
+        '''
+        genes = gene_annotations[['BioMart Associated Gene Name']]
+        hgmd_df = self.hgmd_table(hgmd, genes['BioMart Associated Gene Name'])
+        return genes.join(hgmd_df, on=['BioMart Associated Gene Name', 'SVTYPE'], how='left').drop(columns='BioMart Associated Gene Name')
 
     def prioritized_annotation(self, gene_ref_df, annotation_df, matched_fields):
         matched_rows = []
@@ -251,9 +465,7 @@ class SVAnnotator:
         df2 = df2.drop_duplicates().set_index(field2).dropna(how='all')
         return df1.set_index(field1).join(df2, how='left').drop_duplicates().rename_axis(field1).reset_index()
 
-    def annotate_hpo(self, hpo):
-        matching_fields = {'HPO Gene ID': 'BioMart Ensembl Gene ID',}
-
+    def read_hpo(self, hpo):
         hpo_df = pd.read_csv(hpo, sep='\t')
         hpo_df.columns = hpo_df.columns.str.strip()
         # hpo_df = hpo_df[['Gene ID', 'Gene symbol', 'Features']]
@@ -262,66 +474,71 @@ class SVAnnotator:
 
         hpo_df = hpo_df.astype(str)
         self.append_prefix_to_columns(hpo_df, "HPO")
+        return hpo_df
+
+    def annotate_hpo(self, hpo, hpo_df=None):
+        matching_fields = {'HPO Gene ID': 'BioMart Ensembl Gene ID',}
+
+        hpo_df = self.read_hpo(hpo) if hpo_df is None else hpo_df
         hpo_df = self.left_join(hpo_df, self.gene_ref_df[["BioMart Ensembl Gene ID", 'BioMart Associated Gene Name']], 'HPO Gene ID', "BioMart Ensembl Gene ID")
         hpo_df = hpo_df.rename(columns={'BioMart Associated Gene Name': 'Genes in HPO'})
 
         self.gene_ref_df = self.prioritized_annotation(self.gene_ref_df, hpo_df, matching_fields)
         #self.gene_ref_df.to_csv("hpo_ann.tsv", sep="\t")
     
-    def annotate_omim(self, omim):
-        omim_inheritance_codes = {"Autosomal dominant":"AD", \
-        "Autosomal recessive":"AR", \
-        "X-linked dominant":"XLD", \
-        "X-linked recessive":"XLR", \
-        "Y-linked dominant":"YLD", \
-        "Y-linked recessive":"YLR", \
-        "X-linked":"XL", \
-        "Y-linked":"YL"}
-        omim_inheritance_codes = {key.lower():value for key,value in omim_inheritance_codes.items()} # for case insensitive text search
-
-        def process_OMIM_phenotype(phenotype):
-            '''
-                omim phenotype example:
-                
-                {Epilepsy, generalized, with febrile seizures plus, type 5, susceptibility to}, 613060 (3), Autosomal dominant; 
-                {Epilepsy, idiopathic generalized, 10}, 613060 (3), Autosomal dominant; 
-                {Epilepsy, juvenile myoclonic, susceptibility to}, 613060 (3), Autosomal dominant
-            '''
-
-            inheritance = []
-
-            if pd.isnull(phenotype): return phenotype
-            else:
-                for p in phenotype.split('; '):
-                    multiple_inheritance = [code for description, code in omim_inheritance_codes.items() if description.lower() in p.lower()]
-                    if multiple_inheritance: inheritance.append('&'.join(multiple_inheritance))
-
-                return ', '.join(inheritance)
+    def read_omim(self, omim):
+        '''
+            omim phenotype example:
 
-        matching_fields = {'OMIM Ensembl Gene ID': 'BioMart Ensembl Gene ID'}
+            {Epilepsy, generalized, with febrile seizures plus, type 5, susceptibility to}, 613060 (3), Autosomal dominant; 
+            {Epilepsy, idiopathic generalized, 10}, 613060 (3), Autosomal dominant; 
+            {Epilepsy, juvenile myoclonic, susceptibility to}, 613060 (3), Autosomal dominant
 
+            The inheritance of a gene lists the inheritance codes found in each of its phenotypes, '&' delimited within a phenotype and ', ' between phenotypes
+        '''
         # OMIM adds comments to their CSV file. These comments start with '#' character and are present in the header and footer of the file.
-        omim_df = pd.read_csv(omim, sep='\t', header=3, skipfooter=61, engine='python')
+        # The last comment before the first record is the column header, records end at the first comment after them
+        header_line, n_records = None, 0
+        with open(omim) as f:
+            for i, line in enumerate(f):
+                if line.startswith('#'):
+                    if n_records:
+                        break
+                    header_line = i
+                elif line.strip():
+                    n_records += 1
+        assert header_line is not None, "No commented column header found in %s" % omim
+
+        omim_df = pd.read_csv(omim, sep='\t', skiprows=header_line, nrows=n_records)
         omim_df.columns = omim_df.columns.str.replace('#','')
         omim_df.columns = omim_df.columns.str.strip()
 
         omim_df = omim_df[['MIM Number', 'Ensembl Gene ID', 'Phenotypes']]
         omim_df = omim_df[pd.notnull(omim_df['Phenotypes'])] #drop all nan phenotype columns
-        omim_df['Inheritance'] = omim_df['Phenotypes'].apply(lambda col: process_OMIM_phenotype(col))
+
+        phenotypes = omim_df['Phenotypes'].astype(str).str.split('; ').explode()
+        found = phenotypes.str.extract(OMIM_INHERITANCE_REGEX).notna()
+        inheritance = pd.Series('', index=phenotypes.index)
+        for code in found.columns:
+            inheritance = inheritance + np.where(found[code], '&' + code, '')
+        inheritance = inheritance.str[1:]
+        omim_df['Inheritance'] = inheritance[inheritance != ''].groupby(level=0).agg(', '.join).reindex(omim_df.index, fill_value='')
+
         omim_df = omim_df.astype(str).groupby('Ensembl Gene ID', as_index=False).agg({'Phenotypes' : ' & '.join, 'MIM Number' : ' & '.join, 'Inheritance' : ' & '.join,})
         self.append_prefix_to_columns(omim_df, "OMIM")
+        return omim_df
+
+    def annotate_omim(self, omim, omim_df=None):
+        matching_fields = {'OMIM Ensembl Gene ID': 'BioMart Ensembl Gene ID'}
 
+        omim_df = self.read_omim(omim) if omim_df is None else omim_df
         omim_df = self.left_join(omim_df, self.gene_ref_df[["BioMart Ensembl Gene ID", 'BioMart Associated Gene Name']], 'OMIM Ensembl Gene ID', "BioMart Ensembl Gene ID")
         omim_df = omim_df.rename(columns={'BioMart Associated Gene Name': 'Genes in OMIM'})
 
         self.gene_ref_df = self.prioritized_annotation(self.gene_ref_df, omim_df, matching_fields)
         # self.gene_ref_df.to_csv("omim_ann.tsv", sep="\t")
 
-    def annotate_exac(self, exac):
-        matching_fields = {
-            'ExAC gene' : 'BioMart Associated Gene Name',
-        }
-
+    def read_exac(self, exac):
         exac_df = pd.read_csv(exac, sep='\t')
         exac_df.columns = exac_df.columns.str.strip()
         exac_df['transcript'] = exac_df['transcript'].apply(lambda transcript_id: transcript_id.split('.')[0])
@@ -329,69 +546,229 @@ class SVAnnotator:
 
         exac_df = exac_df.astype(str)
         self.append_prefix_to_columns(exac_df, "ExAC")
+        return exac_df
 
+    def annotate_exac(self, exac, exac_df=None):
+        matching_fields = {
+            'ExAC gene' : 'BioMart Associated Gene Name',
+        }
+
+        exac_df = self.read_exac(exac) if exac_df is None else exac_df
         self.gene_ref_df = self.prioritized_annotation(self.gene_ref_df, exac_df, matching_fields)
         #self.gene_ref_df.to_csv("exac_ann.tsv", sep="\t")
 
+    def gnomad_index(self, gnomad, chroms):
+        '''
+            Index of the gnomAD-SV SVs on chroms, shared by the reports made in the same process. From a .npz index only chromosomes not
+            read before are loaded, a BED is indexed whole once per file and modification time
+        '''
+        cache_key = (os.path.abspath(gnomad), os.stat(gnomad).st_mtime_ns)
+        if cache_key not in gnomad_index_cache:
+            gnomad_index_cache[cache_key] = (set(), {})
+        loaded_chroms, index = gnomad_index_cache[cache_key]
+
+        if not gnomad.endswith('.npz'):
+            if not loaded_chroms:
+                index.update(build_gnomad_index(gnomad))
+                loaded_chroms.add(None)
+        elif not chroms <= loaded_chroms:
+            index.update(load_gnomad_index(gnomad, chroms=chroms - loaded_chroms))
+            loaded_chroms.update(chroms)
+
+        return {key: columns for key, columns in index.items() if key[0] in chroms}
+
     def annotate_gnomad(self, gnomad, sv_record, reciprocal_overlap=0.5):
+        '''
+            gnomad is either the gnomAD-SV BED or an index of it made by crg.build_sv_reference.py (.npz). From an index, only the
+            chromosomes of the report are read
+        '''
+        return sv_record.df.join(self.gnomad_annotations(gnomad, sv_record.df.index, reciprocal_overlap))
+
+    def gnomad_annotations(self, gnomad, sv_index, reciprocal_overlap=0.5):
+        '''
+            Frame of the gnomAD-SV annotations of the SVs in sv_index, see annotate_gnomad
+        '''
         print('Annotating structural variants with those seen in gnomAD_SV based on a %f reciprocal overlap ...' % reciprocal_overlap)
 
-        gnomad_cols = ['CHROM',	'START', 'END', 'NAME',	'SVTYPE', 'AN',	'AC', 'AF', 'N_HOMREF',	'N_HET', 'N_HOMALT', 'FREQ_HOMREF',	'FREQ_HET',	'FREQ_HOMALT',	'POPMAX_AF']
         gnomad_ann_cols = ['gnomAD_SVTYPE', 'gnomAD_AN', 'gnomAD_AC', 'gnomAD_AF', 'gnomAD_N_HOMREF', 'gnomAD_N_HET', 'gnomAD_N_HOMALT', 'gnomAD_FREQ_HOMREF', 'gnomAD_FREQ_HET', 'gnomAD_FREQ_HOMALT', 'gnomAD_POPMAX_AF']
-        gnomad_df = pd.read_csv(gnomad, sep='\t', dtype='str').astype(str)
-        gnomad_df.columns = gnomad_df.columns.str.replace('#', '')
-        gnomad_df.columns = gnomad_df.columns.str.strip()
-        gnomad_df = gnomad_df[gnomad_cols]
-        gnomad_bed = BedTool(gnomad_df.itertuples(index=False))
+        sample_sv = sv_index.to_frame(index=False)
 
-        sample_sv = sv_record.make_ref_bedtool()
-
-        ann_df = sample_sv.intersect(gnomad_bed, wa=True, wb=True, F=reciprocal_overlap, f=reciprocal_overlap).to_dataframe(\
-        names=['CHROM',	'POS', 'END', 'SVTYPE', 'gnomAD_CHROM', 'gnomAD_START', 'gnomAD_END', 'gnomAD_ID', ] + gnomad_ann_cols).astype(str)
-        ann_df = ann_df.drop(ann_df[ann_df['SVTYPE'] != ann_df['gnomAD_SVTYPE']].index)
-
-        ann_df['gnomAD_SV'] = ann_df[['gnomAD_CHROM', 'gnomAD_START', 'gnomAD_END']].apply(lambda x: '{}:{}-{}'.format(x[0],x[1],x[2]), axis=1)
+        gnomad_index = self.gnomad_index(gnomad, set(sample_sv['CHROM']))
+        rows, ann_df = match_gnomad(gnomad_index, sample_sv['CHROM'].values, sample_sv['POS'].values.astype(np.int64), sample_sv['END'].values.astype(np.int64), \
+            sample_sv['SVTYPE'].values, reciprocal_overlap)
+        ann_df.columns = ['gnomAD_CHROM', 'gnomAD_START', 'gnomAD_END', 'gnomAD_ID'] + gnomad_ann_cols
+        ann_df['gnomAD_SV'] = ann_df['gnomAD_CHROM'] + ':' + ann_df['gnomAD_START'] + '-' + ann_df['gnomAD_END']
         ann_df = ann_df.drop(columns=['gnomAD_CHROM', 'gnomAD_START', 'gnomAD_END'])
-        ann_df = ann_df.groupby(['CHROM', 'POS', 'END', 'SVTYPE']).agg(list)
-        ann_df = ann_df[ann_df.columns].applymap(lambda cell: ' & '.join(cell))
+        ann_df.index = sv_index[rows]
+        return ann_df.groupby(level=['CHROM', 'POS', 'END', 'SVTYPE'], sort=False).agg(' & '.join)
 
-        return sv_record.df.join(ann_df)
+    def read_counts(self, counts):
+        '''
+            Read a population count database, once per file and modification time
+        '''
+        cache_key = (os.path.abspath(counts), os.stat(counts).st_mtime_ns)
+        if cache_key not in counts_cache:
+            count_df = pd.read_csv(counts, sep='\t', dtype='str').astype(str)
+            count_df.columns = ['COUNT_CHROM', 'COUNT_START', 'COUNT_END', 'COUNT_SVTYPE', 'COUNT']
+            counts_cache[cache_key] = count_df
+        return counts_cache[cache_key]
 
     def annotate_counts(self, counts, sv_record, prefix="COUNT", reciprocal_overlap=0.5):
-        print('Annotating structural variants with those seen in %s based on a %f reciprocal overlap ...' % (counts, reciprocal_overlap))
+        return self.annotate_counts_batch([counts], sv_record, prefixes=[prefix], reciprocal_overlap=reciprocal_overlap)
 
-        cols = ['COUNT_CHROM', 'COUNT_START', 'COUNT_END', 'COUNT_SVTYPE', 'COUNT']
-        
-        count_df = pd.read_csv(counts, sep='\t', dtype='str').astype(str)
-        count_bed = BedTool(count_df.itertuples(index=False))
+    def annotate_counts_batch(self, counts_list, sv_record, prefixes=None, reciprocal_overlap=0.5, threads=1):
+        '''
+            Annotate the SVs with the population counts of each count database in counts_list, under the matching prefix in prefixes
+            (by default the file name without its extension). Each database adds a prefix column, the summed counts of the SVs matched in it,
+            and a prefix_SV column spanning them. Each database is read once per process and modification time, in counts_cache
 
-        sample_sv = sv_record.make_ref_bedtool()
+            Implementation:
+                The intervals of the report are collected once and matched against each database with reciprocal_overlap_join,
+                in a pool of threads when threads > 1. The annotations of all databases are joined on to the report at once
+        '''
+        return sv_record.df.join(self.count_annotations(counts_list, sv_record.df.index, prefixes, reciprocal_overlap, threads))
 
-        ann_df = sample_sv.intersect(count_bed, wa=True, wb=True, F=reciprocal_overlap, f=reciprocal_overlap).to_dataframe(\
-        names=['CHROM',	'POS', 'END', 'SVTYPE', ] + cols)
-        ann_df[['CHROM', 'POS', 'END', 'SVTYPE', ]] = ann_df[['CHROM',	'POS', 'END', 'SVTYPE', ]].astype(str) # reference dataframe is typecasted as string
-        ann_df = ann_df.drop(ann_df[ann_df['SVTYPE'] != ann_df['COUNT_SVTYPE']].index)
-        
-        ann_df = ann_df.groupby(['CHROM', 'POS', 'END', 'SVTYPE']).agg({'COUNT_CHROM' : 'first', 'COUNT_SVTYPE' : 'first', 'COUNT_START' : 'min', 'COUNT_END' : 'max', 'COUNT' : 'sum'})
-        ann_df['COUNT_SV'] = ann_df[['COUNT_CHROM', 'COUNT_START', 'COUNT_END']].apply(lambda x: '{}:{}-{}'.format(x[0],x[1],x[2]), axis=1)
-        ann_df = ann_df.drop(columns=['COUNT_CHROM', 'COUNT_START', 'COUNT_END', 'COUNT_SVTYPE'])
+    def count_annotations(self, counts_list, sv_index, prefixes=None, reciprocal_overlap=0.5, threads=1):
+        '''
+            Frame of the population count annotations of the SVs in sv_index, see annotate_counts_batch
+        '''
+        prefixes = [Path(counts).stem for counts in counts_list] if prefixes is None else prefixes
+        sample_sv = sv_index.to_frame(index=False)
+        sample_starts, sample_ends = sample_sv['POS'].values.astype(np.int64), sample_sv['END'].values.astype(np.int64)
+
+        def match_counts(counts, prefix):
+            print('Annotating structural variants with those seen in %s based on a %f reciprocal overlap ...' % (counts, reciprocal_overlap))
+
+            cols = ['COUNT_CHROM', 'COUNT_START', 'COUNT_END', 'COUNT_SVTYPE', 'COUNT']
+            count_df = self.read_counts(counts)
 
-        ann_df.columns = ann_df.columns.str.replace('COUNT', prefix)
+            rows, count_rows = reciprocal_overlap_join(sample_sv['CHROM'].values, sample_starts, sample_ends, sample_sv['SVTYPE'].values, \
+                count_df['COUNT_CHROM'].values, count_df['COUNT_START'].values.astype(np.int64), count_df['COUNT_END'].values.astype(np.int64), count_df['COUNT_SVTYPE'].values, reciprocal_overlap)
+            ann_df = pd.DataFrame({col: infer_like_read_csv(count_df[col].values[count_rows]) for col in cols}, index=rows)
 
-        df = sv_record.df.join(ann_df)
-        df[[prefix]] = df[[prefix]].fillna(0)
+            ann_df = ann_df.groupby(level=0).agg({'COUNT_CHROM' : 'first', 'COUNT_SVTYPE' : 'first', 'COUNT_START' : 'min', 'COUNT_END' : 'max', 'COUNT' : 'sum'})
+            ann_df['COUNT_SV'] = ann_df['COUNT_CHROM'].astype(str) + ':' + ann_df['COUNT_START'].astype(str) + '-' + ann_df['COUNT_END'].astype(str)
+            ann_df = ann_df.drop(columns=['COUNT_CHROM', 'COUNT_START', 'COUNT_END', 'COUNT_SVTYPE'])
+            ann_df.index = sv_index[ann_df.index]
+
+            ann_df.columns = ann_df.columns.str.replace('COUNT', prefix)
+            return ann_df
+
+        if threads > 1 and len(counts_list) > 1:
+            with ThreadPoolExecutor(max_workers=min(threads, len(counts_list))) as pool:
+                ann_dfs = list(pool.map(match_counts, counts_list, prefixes))
+        else:
+            ann_dfs = [match_counts(counts, prefix) for counts, prefix in zip(counts_list, prefixes)]
+
+        df = pd.DataFrame(index=sv_index)
+        df = df.join(ann_dfs) if ann_dfs else df
+        df[prefixes] = df[prefixes].fillna(0)
 
         return df
 
-    def annotsv(self, sample_df):
+    def annotsv_version(self):
+        '''
+            Identify the AnnotSV install in $ANNOTSV by its reported version and the SHA-256 of its script, which keys the AnnotSV cache
+        '''
+        result = subprocess.run('$ANNOTSV/bin/AnnotSV -version', shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+        script = os.path.join(os.environ.get('ANNOTSV', ''), 'bin', 'AnnotSV')
+        return '%s %s' % (result.stdout.strip(), file_digest(script) if os.path.isfile(script) else '')
+
+    def run_annotsv(self, sv_df):
+        '''
+            Run AnnotSV on the SVs in sv_df in a temporary directory of its own, so that concurrent runs in the same directory do not collide.
+            Returns the header of the AnnotSV output and a dict mapping the CHROM, POS, END, SVTYPE of each SV to its output lines.
+            Raises subprocess.CalledProcessError if AnnotSV fails, so that nothing from a failed run is cached
+        '''
+        tmp_dir = tempfile.mkdtemp(prefix='annotsv.', dir='.')
+        try:
+            all_sv_bed_name = os.path.join(tmp_dir, "all_sv.bed")
+            annotated = "{}.annotated.tsv".format(all_sv_bed_name)
+            sv_df.to_csv(all_sv_bed_name, index=False, sep='\t')
+            subprocess.check_call("$ANNOTSV/bin/AnnotSV -SVinputFile {} -SVinputInfo 1 -outputFile {}".format(shlex.quote(all_sv_bed_name), shlex.quote(annotated)), shell=True)
+
+            lines = defaultdict(list)
+            with open(annotated) as f:
+                header = f.readline().rstrip('\n')
+                sv_fields = [header.split('\t').index(col) for col in ('SV chrom', 'SV start', 'SV end', 'SV type')]
+                for line in f:
+                    line = line.rstrip('\n')
+                    fields = line.split('\t')
+                    lines[tuple(fields[i] for i in sv_fields)].append(line)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        return header, lines
+
+    def annotsv(self, sample_df, annotsv_cache=None, threads=1):
         '''
             Handles DGV, DDD annotations
+
+            The AnnotSV output lines of each SV are memoized in annotsv_lines_cache, so later reports in the same process only send the SVs
+            not annotated before to AnnotSV. With annotsv_cache, a SQLite file, the AnnotSV output lines of each SV are stored under the AnnotSV version and only SVs not seen
+            before by this version of AnnotSV are sent to it. With threads > 1, those are split in to batches of whole chromosomes that
+            are annotated by concurrent AnnotSV runs. The output lines of all SVs of the report are then parsed together, as from a single run.
+            SVs missing from the AnnotSV output are not cached, so they are sent to AnnotSV again by the next report
         '''
-        all_sv_bed_name = "all_sv.bed"
-        annotated = "./{}.annotated.tsv".format(all_sv_bed_name)
-        sample_df.reset_index()[['CHROM', 'POS', 'END', 'SVTYPE']].to_csv(all_sv_bed_name, index=False, sep='\t')
-        subprocess.call("$ANNOTSV/bin/AnnotSV -SVinputFile {} -SVinputInfo 1 -outputFile {}".format(all_sv_bed_name, annotated), shell=True)
+        return sample_df.join(self.annotsv_annotations(sample_df.index, annotsv_cache, threads))
 
+    def annotsv_annotations(self, sv_index, annotsv_cache=None, threads=1):
+        '''
+            Frame of the AnnotSV annotations of the SVs in sv_index, see annotsv
+        '''
+        sv_df = sv_index.to_frame(index=False)[['CHROM', 'POS', 'END', 'SVTYPE']].astype(str)
+        keys = list(sv_df.itertuples(index=False, name=None))
+        version = self.annotsv_version()
+        memo = annotsv_lines_cache.setdefault(version, {'header': None, 'lines': {}})
+        header = memo['header']
+        lines = {key: memo['lines'][key] for key in keys if key in memo['lines']}
+
+        if annotsv_cache is not None:
+            conn = sqlite3.connect(annotsv_cache, timeout=600)
+            conn.executescript('''
+                CREATE TABLE IF NOT EXISTS ANNOTSV_HEADER (version TEXT PRIMARY KEY, header TEXT);
+                CREATE TABLE IF NOT EXISTS ANNOTSV_SV (version TEXT, chrom TEXT, pos TEXT, end TEXT, svtype TEXT, lines TEXT, PRIMARY KEY (version, chrom, pos, end, svtype));
+                CREATE TEMP TABLE REPORT_SV (chrom TEXT, pos TEXT, end TEXT, svtype TEXT);
+            ''')
+            conn.executemany('INSERT INTO REPORT_SV VALUES (?, ?, ?, ?)', keys)
+
+            row = conn.execute('SELECT header FROM ANNOTSV_HEADER WHERE version = ?', (version,)).fetchone()
+            header = row[0] if row else header
+            for chrom, pos, end, svtype, sv_lines in conn.execute('''
+                SELECT sv.chrom, sv.pos, sv.end, sv.svtype, sv.lines FROM ANNOTSV_SV AS sv
+                JOIN REPORT_SV USING (chrom, pos, end, svtype) WHERE sv.version = ?
+            ''', (version,)):
+                lines[(chrom, pos, end, svtype)] = sv_lines.split('\n') if sv_lines else []
+            print('Found AnnotSV annotations of %d of %d structural variants in %s' % (len(lines), len(keys), annotsv_cache))
+
+        misses = sv_df[[key not in lines for key in keys]]
+        if len(misses) or header is None:
+            # balance whole chromosomes over the batches, largest first
+            batches = [[] for i in range(max(1, min(threads, misses['CHROM'].nunique())))]
+            for chrom, chrom_df in sorted(misses.groupby('CHROM'), key=lambda item: len(item[1]), reverse=True):
+                min(batches, key=lambda batch: sum(len(df) for df in batch)).append(chrom_df)
+            batches = [pd.concat(batch) if batch else misses for batch in batches]
+
+            with ThreadPoolExecutor(max_workers=len(batches)) as pool:
+                results = list(pool.map(self.run_annotsv, batches))
+
+            new_lines = {}
+            for batch, (header, batch_lines) in zip(batches, results):
+                new_lines.update((key, batch_lines[key]) for key in batch.itertuples(index=False, name=None) if key in batch_lines)
+            lines.update(new_lines)
+
+            if annotsv_cache is not None:
+                with conn:
+                    conn.execute('INSERT OR REPLACE INTO ANNOTSV_HEADER VALUES (?, ?)', (version, header))
+                    conn.executemany('INSERT OR REPLACE INTO ANNOTSV_SV VALUES (?, ?, ?, ?, ?, ?)', ((version,) + key + ('\n'.join(sv_lines),) for key, sv_lines in new_lines.items()))
+
+        if annotsv_cache is not None:
+            conn.close()
+
+        memo['header'] = header
+        memo['lines'].update(lines)
+
+        annotated = io.StringIO('\n'.join([header] + [line for key in dict.fromkeys(keys) for line in lines.get(key, [])]) + '\n')
         annotsv_df_original = pd.read_csv(annotated, sep='\t').astype(str)
         # DDD annotations are only given to SVs that are 'split'
         # but we want the DGV annotations that are given to the 'full' SVs
@@ -411,67 +788,78 @@ class SVAnnotator:
                                                                             'DDD_pmids':  ','.join}).reset_index()
 
         annotsv_df = annotsv_df.rename(columns={annotsv_df.columns[0]: 'CHROM', annotsv_df.columns[1]: 'POS', annotsv_df.columns[2]: 'END', annotsv_df.columns[3]:'SVTYPE'}).set_index(keys=['CHROM', 'POS', 'END', 'SVTYPE'])
-        sample_df = sample_df.join(annotsv_df)
-
-        os.remove(all_sv_bed_name)
-        #os.remove(annotated)
 
-        return sample_df
+        return annotsv_df
 
-    def make_gene_ref_df(self, biomart):
+    def read_biomart(self, biomart):
         df = pd.read_csv(biomart, sep='\t')
         # df = df[['Ensembl Gene ID', 'Ensembl Transcript ID', 'Associated Gene Name', 'HGNC ID(s)', 'MIM Gene Accession']].drop_duplicates()
         df = df[['Ensembl Gene ID', 'Associated Gene Name',]].drop_duplicates()
         df['Associated Gene Name'] = df['Associated Gene Name'].apply(lambda symbol: symbol.upper()) #make all gene symbols a single case to increase match rate with other dataframes
         df = df.astype(str)
         self.append_prefix_to_columns(df, "BioMart")
-        
-        self.gene_ref_df = df
+        return df
+
+    def make_gene_ref_df(self, biomart, biomart_df=None):
+        self.gene_ref_df = self.read_biomart(biomart) if biomart_df is None else biomart_df
     
-    def annotate_genes(self, sample_df, gene_col):
-        def count_unique_terms(cell):
-            terms = set()
+    def annotate_genes(self, sample_df, gene_col, gene_df=None):
+        '''
+            Annotate each SV with the reference annotations of its genes, ' | ' delimited.
 
-            for elem in cell:
-                if pd.isnull(elem):
-                    continue
-                elif ', ' in elem:
-                    terms.update(elem.split(', '))
-                elif elem != 'na' and elem != 'nan':
-                    terms.add(elem)
+            gene_df is an exploded table of gene ids (ex. SVGrouper.gene_df) indexed by CHROM, POS, END, SVTYPE with the ids in gene_col.
+            If it is not given, the genes are taken from lists of gene ids in the gene_col column of sample_df
 
-            return len(terms)
+            Implementation:
+                The genes are joined to the reference annotations one row per gene, then every column is aggregated per SV with a single grouped string join.
+                Missing annotations are 'na', and a column without any annotation for an SV is a single 'na'.
+                The N_ columns count the unique terms per SV on the exploded terms
+        '''
+        return sample_df.drop(columns=gene_col, errors='ignore').join(self.gene_annotations(sample_df, gene_col, gene_df))
+
+    def gene_annotations(self, sample_df, gene_col, gene_df=None):
+        '''
+            Frame of the gene annotations of the SVs, with one row per SV with genes, see annotate_genes
+        '''
+        index_cols = ['CHROM', 'POS', 'END', 'SVTYPE']
+
+        def count_unique_terms(col):
+            # cells holding ', ' delimited lists count each of their terms, other cells count unless they are missing
+            terms = gene_df[index_cols + [col]].dropna(subset=[col])
+            multiple = terms[col].str.contains(', ', regex=False)
+            single = terms[~multiple & ~terms[col].isin(['na', 'nan'])]
+            multiple = terms[multiple].assign(**{col: terms.loc[multiple, col].str.split(', ')}).explode(col)
 
-        # extract genes from sample_df, create a new dataframe where each row only has a single ensemble id and interval info
-        gene_df = sample_df.apply(lambda x: pd.Series(x[gene_col]),axis=1).stack().reset_index(level=4, drop=True)
-        gene_df = gene_df.to_frame().rename(columns={0: gene_col}).astype(str)
-        # gene_df.to_csv('seperated_genes.csv')
+            counts = pd.concat([single, multiple]).groupby(index_cols)[col].nunique()
+            return counts.reindex(annotations.index, fill_value=0).astype(str)
+
+        if gene_df is None:
+            # extract genes from sample_df, create a new dataframe where each row only has a single ensemble id and interval info
+            gene_df = sample_df[gene_col].explode().dropna().to_frame()
+        gene_df = gene_df[[gene_col]].astype(str)
 
         # annotate passed in ensemble gene id's using the generated reference dataframe
         gene_df = gene_df.join(self.gene_ref_df, on=gene_col, how='left').reset_index()
-        # gene_df.to_csv('annotated_genes.csv')
+        ann_cols = [col for col in gene_df.columns if col not in index_cols]
+
+        # replace nan values with "na" string and aggregate all annotation columns within the same sv interval
+        values = gene_df[ann_cols].astype(str)
+        missing = values.apply(lambda col: col.str.lower() == 'nan')
+        values = values.mask(missing, 'na')
+        values[index_cols] = gene_df[index_cols]
+        missing[index_cols] = gene_df[index_cols]
 
-        # aggregate all annotation columns within the same sv interval
-        gene_df = gene_df.groupby(['CHROM', 'POS', 'END', 'SVTYPE']).agg(list)
-        # gene_df.to_csv('grouped_index.csv')
+        annotations = values.groupby(index_cols).agg(' | '.join)
+        annotations = annotations.mask(missing.groupby(index_cols).all(), 'na')
 
         # add cardinality columns
         if self.HPO:
-            gene_df["N_UNIQUE_HPO_TERMS"] = [ [count_unique_terms(values["HPO Features"])] for index, values in gene_df.iterrows()]
-            gene_df["N_GENES_IN_HPO"] = [ [count_unique_terms(values["Genes in HPO"])] for index, values in gene_df.iterrows()]
-        gene_df["N_GENES_IN_OMIM"] = [ [count_unique_terms(values["Genes in OMIM"])] for index, values in gene_df.iterrows()]
-
-        # parse out and replace nan values with "na" string
-        gene_df[gene_df.columns] = gene_df[gene_df.columns].applymap(lambda cell: [str(item) for item in cell])
-        gene_df[gene_df.columns] = gene_df[gene_df.columns].applymap(lambda cell: ["na"] if all("nan" == item.lower() for item in cell) else cell)
-        gene_df[gene_df.columns] = gene_df[gene_df.columns].applymap(lambda cell: ["na" if "nan" == item.lower() else item for item in cell])
-
-        gene_df[gene_df.columns] = gene_df[gene_df.columns].applymap(lambda cell: ' | '.join(cell))
-        gene_df = gene_df[gene_df.columns]
+            annotations["N_UNIQUE_HPO_TERMS"] = count_unique_terms("HPO Features")
+            annotations["N_GENES_IN_HPO"] = count_unique_terms("Genes in HPO")
+        annotations["N_GENES_IN_OMIM"] = count_unique_terms("Genes in OMIM")
 
-        # annotate the passed in dataframe
-        sample_df = sample_df.drop(gene_col, axis=1).join(gene_df)
-        return sample_df
+        return annotations
 
     def add_decipher_link(self, df):
-        df['DECIPHER_LINK'] = ['''=HYPERLINK("https://decipher.sanger.ac.uk/browser#q/%s:%s-%s")''' % index[0:3] for index, fields in df.iterrows()]
+        chrom, pos, end = (df.index.get_level_values(level).astype(str).values.astype(object) for level in range(3))
+        df['DECIPHER_LINK'] = '=HYPERLINK("https://decipher.sanger.ac.uk/browser#q/' + chrom + ':' + pos + '-' + end + '")'
@@ -1,101 +1,370 @@
 import allel
 import numpy as np
 import pandas as pd
+import gzip
 import os
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, repeat
 from pybedtools import BedTool
+from .cache import DEFAULT_CACHE_SIZE, FileCache, file_digest
+from .compact import pooled_categoricals, share_categories
+from .overlap import connected_components, intersect_intervals, reciprocal_overlap_join, reciprocal_overlap_pairs
+
+STATE_VERSION = 1
+PARSER_VERSION = 1 #increment when the output of parse_sv_vcf changes, to invalidate cached parses
+CLUSTER_MODES = ['first', 'transitive']
+ANN_GENE_ID = 4 #position of Gene_ID in snpEff's 'Allele | Annotation | Annotation_Impact | Gene_Name | Gene_ID | ...' ANN format
+
+def open_vcf(vcf_path):
+    '''
+        Open a vcf as a binary stream, decompressing it if it is gzipped
+    '''
+    opener = gzip.open if vcf_path.endswith('.gz') else open
+    return opener(vcf_path, 'rb')
+
+def read_ann_gene_ids(vcf_lines):
+    '''
+        Stream the Ensembl gene ids out of the snpEff ANN field of the lines of a vcf, yielding a list of ids for each record in file order.
+        Blank or truncated lines, which allel reads as empty records, have no ids instead of failing
+
+        Only the INFO column is split and only the Gene_ID of each annotation is kept, so unlike reading ANN with allel.ANNTransformer
+        no fixed width matrix of annotation strings is allocated
+    '''
+    for line in vcf_lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        if line.startswith('#'):
+            continue
+
+        gene_ids = []
+        fields = line.rstrip('\r\n').split('\t', 8)
+        if len(fields) > 7:
+            for field in fields[7].split(';'):
+                if field.startswith('ANN='):
+                    for ann in field[4:].split(','):
+                        ann = ann.split('|', ANN_GENE_ID + 1)
+                        if len(ann) > ANN_GENE_ID and ann[ANN_GENE_ID]:
+                            gene_ids.append(ann[ANN_GENE_ID])
+                    break
+
+        yield gene_ids
+
+def explode_gene_ids(gene_ids):
+    '''
+        Make a DataFrame with one row per record position and unique Ensembl gene id from lists of ANN gene ids.
+        Gene ids of fusions and overlapping genes are delimited by '-' or '&' (ex. ENSG00000225630-ENSG00000237973) and are split apart
+    '''
+    gene_ids = list(gene_ids)
+    gene_df = pd.DataFrame({
+        'record': np.repeat(np.arange(len(gene_ids)), [len(id_list) for id_list in gene_ids]),
+        'Ensembl Gene ID': pd.Series(list(chain.from_iterable(gene_ids)), dtype=object).str.split('[-&]'),
+    })
+    gene_df = gene_df.explode('Ensembl Gene ID')
+    gene_df = gene_df[gene_df['Ensembl Gene ID'].str.len() > 0]
+
+    return gene_df.drop_duplicates().reset_index(drop=True)
+
+def parse_sv_vcf(vcf_path, index_fields, ann_fields=[]):
+    '''
+        Parse the SV intervals, genotypes and ann_fields of a single sample vcf in to a DataFrame, and its Ensembl gene ids in to an exploded
+        DataFrame whose 'record' column refers to the rows of the first
+
+        Defined at module level so that it can be run in a worker process by SVGrouper._parse_sv_vcfs. Returns the sample name and both DataFrames
+    '''
+    parse_fields = list(dict.fromkeys(index_fields + ['calldata/GT', 'samples'] + ann_fields))
+
+    vcf_dict = allel.read_vcf(vcf_path, parse_fields) #use read_vcf because genotype field is not picked up with vcf_to_dataframe
+
+    assert len(vcf_dict['samples']) == 1, "%s contains 0 or more than 1 sample: %s" % (vcf_path, str(vcf_dict['samples']))
+    name = vcf_dict.pop('samples')[0]
+
+    # if 'chr' in CHROM field, remove
+    vcf_dict['variants/CHROM'] = [chrom.strip('chr') for chrom in vcf_dict['variants/CHROM']]
+
+    vcf_dict['calldata/GT'] = np.array(['HET' if 0 in gt and 1 in gt else 'HOM' for gt in vcf_dict.pop('calldata/GT')])
+
+    df = pd.DataFrame(vcf_dict)
+    df['samples'] = name
+    df['record'] = np.arange(len(df))
+
+    # workaround for START > END so BedTool doesn't freak out using MalformedBedError
+    # START > END is the case for TRV, INV
+    s = df['variants/END'] < df['variants/POS']
+    df.loc[s, ['variants/END','variants/POS']] = df.loc[s, ['variants/POS','variants/END']].values
+    df['variants/POS'] = df['variants/POS'].astype(int)
+    df['variants/END'] = df['variants/END'].astype(int)
+    df = df.drop_duplicates(subset=[col for col in df.columns if col != 'record'])
+
+    # exploded table with one row per record and Ensembl gene id, renumbered to the rows of df
+    # the vcf is streamed a second time rather than held in memory for both passes
+    with open_vcf(vcf_path) as vcf:
+        gene_df = explode_gene_ids(read_ann_gene_ids(vcf))
+    gene_df = gene_df[gene_df['record'].isin(df['record'])]
+    gene_df = gene_df.assign(record=np.searchsorted(df['record'].values, gene_df['record'].values))
+
+    return name, df.drop(columns='record').reset_index(drop=True), gene_df
+
+def parse_sv_vcf_cached(vcf_path, index_fields, ann_fields=[], cache_dir=None, cache_size=DEFAULT_CACHE_SIZE):
+    '''
+        parse_sv_vcf through a FileCache in cache_dir, keyed by the content of the vcf and the parser options. A hit skips parsing entirely
+    '''
+    if cache_dir is None:
+        return parse_sv_vcf(vcf_path, index_fields, ann_fields)
+
+    cache = FileCache(cache_dir, cache_size)
+    key = cache.make_key('parse_sv_vcf', PARSER_VERSION, file_digest(vcf_path), index_fields, ann_fields)
+    parsed = cache.get(key)
+
+    if parsed is None:
+        parsed = parse_sv_vcf(vcf_path, index_fields, ann_fields)
+        cache.put(key, parsed)
+    else:
+        print('Using cached parse of %s' % vcf_path)
+
+    return parsed
+
+def group_intervals(intervals, reciprocal_overlap=0.5):
+    '''
+        Group intervals by reciprocal overlap. Each interval joins the group of the first interval it overlaps with the same SVTYPE.
+
+        intervals are tuples of CHROM, POS, END, SVTYPE, genotype, row number and sample name.
+        Returns a list of (reference interval, (row number of the reference interval, members)) pairs sorted by reference interval,
+        where members maps each sample to the SV details and genotypes of its intervals in the group.
+        Defined at module level so that it can be run in a worker process by SVGrouper._group_sv
+    '''
+    already_grouped_intervals = set()
+    groups = {}
+
+    for l in intersect_intervals(intervals, reciprocal_overlap=reciprocal_overlap):
+
+        ref_chr, ref_start, ref_end, ref_svtype, ref_gt, ref_row, ref_name, \
+        samp_chr, samp_start, samp_end, samp_svtype, samp_gt, samp_row, samp_name = l
+
+        ref_interval = (ref_chr, ref_start, ref_end, ref_svtype)
+        samp_interval = (samp_chr, samp_start, samp_end, samp_svtype, samp_gt, samp_name)
+
+        if (samp_interval not in already_grouped_intervals) and (ref_svtype == samp_svtype):
+            add_interval(groups, ref_interval, int(ref_row), samp_interval)
+            already_grouped_intervals.add(samp_interval)
+
+    return sorted(groups.items())
+
+def cluster_intervals(intervals, reciprocal_overlap=0.5):
+    '''
+        Group intervals in to the connected components of the reciprocal overlap graph: two intervals with the same SVTYPE are in the same
+        group if a chain of intervals, each overlapping the next by reciprocal_overlap, links them. Unlike group_intervals the groups do not
+        depend on the order of the intervals.
+
+        The reference interval of a group is its medoid breakpoints, the member in the middle when the members are sorted by POS and END.
+        Takes and returns the same structures as group_intervals, so that the two can be swapped
+
+        Implementation:
+            The edges are found with reciprocal_overlap_pairs, a sort-and-sweep over the sorted intervals of each CHROM and SVTYPE, and joined
+            in to components by connected_components, a union-find over NumPy arrays. Both run in close to O(n log n) for the sparse overlaps of SV calls
+    '''
+    intervals = [tuple(str(field) for field in interval) for interval in intervals]
+    if not intervals:
+        return []
+
+    chroms, starts, ends, svtypes, gts, rows, names = (np.array(field) for field in zip(*intervals))
+    starts, ends = starts.astype(np.int64), ends.astype(np.int64)
+    pairs_a, pairs_b = reciprocal_overlap_pairs(chroms, starts, ends, svtypes, reciprocal_overlap)
+    clusters = connected_components(len(intervals), pairs_a, pairs_b)
+
+    # members of each cluster sorted by breakpoints, then sample name, so that the medoid and the order of SV details are deterministic
+    order = np.lexsort((rows.astype(np.int64), names, ends, starts, clusters))
+    first = np.flatnonzero(np.r_[True, np.diff(clusters[order]) != 0])
+    last = np.r_[first[1:], len(order)]
+    medoids = order[(first + last - 1) // 2]
+    ref_of_member = medoids[np.repeat(np.arange(len(first)), last - first)]
+    already_grouped_intervals = set()
+    groups = {}
+
+    for i, ref in zip(order.tolist(), ref_of_member.tolist()):
+        samp_chr, samp_start, samp_end, samp_svtype, samp_gt, samp_row, samp_name = intervals[i]
+        samp_interval = (samp_chr, samp_start, samp_end, samp_svtype, samp_gt, samp_name)
+
+        if samp_interval not in already_grouped_intervals:
+            add_interval(groups, intervals[ref][:4], int(intervals[ref][5]), samp_interval)
+            already_grouped_intervals.add(samp_interval)
+
+    return sorted(groups.items())
+
+def add_interval(groups, ref_interval, ref_row, samp_interval):
+    '''
+        Record samp_interval as a member of the group represented by ref_interval
+
+        Group rows are only materialized by SVGrouper._make_group_df once all intervals have been grouped, growing a DataFrame one row at a time is very slow
+    '''
+    samp_chr, samp_start, samp_end, samp_svtype, samp_gt, samp_name = samp_interval
+
+    if ref_interval not in groups:
+        groups[ref_interval] = (ref_row, {})
+    members = groups[ref_interval][1]
+
+    if samp_name not in members:
+        members[samp_name] = ([], [])
+    details, genotypes = members[samp_name]
+
+    details.append('{}:{}-{}:{}'.format(samp_chr, samp_start, samp_end, samp_svtype))
+    genotypes.append(samp_gt)
 
 class SVGrouper:
-    def __init__(self, vcfs, ann_fields=[]):
-        def list2string(col):
-            return col.apply(lambda x: ', '.join(x) if isinstance(x, list) else x)
-
+    def __init__(self, vcfs, ann_fields=[], threads=1, shard_by_chrom=False, cache_dir=None, cache_size=DEFAULT_CACHE_SIZE, cluster_mode='first'):
         #key - dataframe col name : value - vcf field name
         self.index_cols = {'variants/CHROM':'CHROM', 'variants/POS':'POS', 'variants/END':'END', 'variants/SVTYPE':'SVTYPE'}
 
-        all_sv, ann_df, sample_list = self._parse_sv_vcfs(vcfs, ann_fields=ann_fields)
+        all_sv, gene_df, ann_df, sample_list = self._parse_sv_vcfs(vcfs, ann_fields=ann_fields, threads=threads, cache_dir=cache_dir, cache_size=cache_size)
         assert len(sample_list) == len(set(sample_list)), "Duplicate sample names among input vcf's detected: %s" % sample_list
 
-        columns = ['CHROM', 'POS', 'END', 'SVTYPE', 'Ensembl Gene ID', 'N_SAMPLES']
-        columns.extend(sample_list)
-        columns.extend(["%s_SV_DETAILS" % s for s in sample_list])
-        columns.extend(["%s_GENOTYPE" % s for s in sample_list])
-
         self.sample_list = sample_list
-        self.df = pd.DataFrame(columns=columns).set_index(keys=list(self.index_cols.values()))
-        self._group_sv(all_sv)
-        self.df['Ensembl Gene ID'] = self.df['Ensembl Gene ID'].apply(lambda gene_list: list(set(gene_list.split(','))) if ',' in gene_list else [gene_list]) #list set typecast is to ensure that we get a list of unique ensemble identifiers
+        self.ann_fields = ann_fields
+        self.ann_df = ann_df
+        self.n_parsed_intervals = len(all_sv) # intervals parsed from vcfs, before grouping
+        # self.gene_df holds the Ensembl gene ids of each grouped SV, one per row, in a categorical column
+        self._group_sv(all_sv, gene_df, threads=threads, shard_by_chrom=shard_by_chrom, cluster_mode=cluster_mode)
         self.bedtool = self.make_ref_bedtool()
 
-        for name in self.sample_list:
-            self.df["%s_SV_DETAILS" % name] = list2string(self.df["%s_SV_DETAILS" % name])
-            self.df["%s_GENOTYPE" % name] = list2string(self.df["%s_GENOTYPE" % name])
-
         # append annotation fields to final df
         self.df = self.df.join(ann_df, how='left')
 
-    def _parse_sv_vcfs(self, vcf_paths, ann_fields=[]):
+    @classmethod
+    def from_state(cls, state_path):
         '''
-            Merge all SV interval data from multiple vcf's in to a single BedTool instance
+            Load a grouping saved with save_state, so that more samples can be added to it with add_vcfs
+        '''
+        state = pd.read_pickle(state_path)
+        assert state['version'] == STATE_VERSION, "%s was saved by an incompatible version of SVGrouper" % state_path
+
+        self = cls.__new__(cls)
+        self.index_cols = {'variants/CHROM':'CHROM', 'variants/POS':'POS', 'variants/END':'END', 'variants/SVTYPE':'SVTYPE'}
+        self.sample_list = state['sample_list']
+        self.ann_fields = state['ann_fields']
+        self.ann_df = state['ann_df']
+        self.gene_df = state['gene_df']
+        self.df = state['df'].join(self.ann_df, how='left')
+        self.bedtool = self.make_ref_bedtool()
+        self.n_parsed_intervals = 0
+
+        return self
+
+    def save_state(self, state_path):
+        '''
+            Save the grouping: the group representatives (index of self.df), their genes, the per-sample membership columns and the annotation fields.
+            Must be called before any annotation columns are added to self.df
+        '''
+        state = {
+            'version': STATE_VERSION,
+            'sample_list': self.sample_list,
+            'ann_fields': self.ann_fields,
+            'ann_df': self.ann_df,
+            'gene_df': self.gene_df,
+            'df': self.df[self._group_cols(self.sample_list)],
+        }
+        pd.to_pickle(state, state_path)
+
+    def add_vcfs(self, vcfs, threads=1, reciprocal_overlap=0.5, cache_dir=None, cache_size=DEFAULT_CACHE_SIZE, cluster_mode='first'):
+        '''
+            Add the samples of vcfs to the grouping without regrouping the samples already in it
 
             Implementation:
-                Use Panda's dataframe for some easy preprocessing, then create a BedTool from a tuple containing each row
+                Only the new intervals are matched, with reciprocal_overlap_join, against the stored group representatives (the index of self.df).
+                A new interval joins the first group in sort order whose representative it overlaps, intervals that match no group are grouped among
+                themselves by group_intervals, or cluster_intervals with the 'transitive' cluster_mode. The new sample columns are joined on to the existing groups and the new groups are appended.
+                Unlike a full regrouping, a new interval is only compared to representatives and not to every interval already grouped.
+        '''
+        all_sv, gene_df, ann_df, sample_list = self._parse_sv_vcfs(vcfs, ann_fields=self.ann_fields, threads=threads, cache_dir=cache_dir, cache_size=cache_size)
+        assert not set(sample_list) & set(self.sample_list) and len(sample_list) == len(set(sample_list)), \
+            "Duplicate sample names among input vcf's detected: %s" % (self.sample_list + sample_list)
+
+        intervals = [tuple(str(field) for field in interval) for interval in all_sv]
+        self.n_parsed_intervals = len(intervals) # intervals parsed from the added vcfs
+        ref_intervals = list(self.df.index)
+        refs = self.df.index.to_frame(index=False)
+        matched = {}
+        unmatched = []
+
+        if intervals:
+            chroms, starts, ends, svtypes = zip(*(interval[:4] for interval in intervals))
+            pairs_new, pairs_ref = reciprocal_overlap_join(chroms, np.array(starts).astype(np.int64), np.array(ends).astype(np.int64), svtypes, \
+                refs['CHROM'].values, refs['POS'].values.astype(np.int64), refs['END'].values.astype(np.int64), refs['SVTYPE'].values, reciprocal_overlap)
+
+            # pairs are ordered by new interval then group, keep the first group of each new interval
+            first = np.unique(pairs_new, return_index=True)
+            ref_of_interval = dict(zip(first[0].tolist(), pairs_ref[first[1]].tolist()))
+
+            already_grouped_intervals = set()
+            for i, (samp_chr, samp_start, samp_end, samp_svtype, samp_gt, samp_row, samp_name) in enumerate(intervals):
+                samp_interval = (samp_chr, samp_start, samp_end, samp_svtype, samp_gt, samp_name)
+                if i not in ref_of_interval:
+                    unmatched.append(intervals[i])
+                elif samp_interval not in already_grouped_intervals:
+                    add_interval(matched, ref_intervals[ref_of_interval[i]], None, samp_interval)
+                    already_grouped_intervals.add(samp_interval)
+
+        new_groups = self._group_func(cluster_mode)(unmatched, reciprocal_overlap)
+        sample_list = self.sample_list + sample_list
+        group_cols = self._group_cols(sample_list)
+
+        # existing groups: join the new samples' columns and update N_SAMPLES
+        matched_df = self._make_group_df(sorted(matched.items()), sample_list=sample_list[len(self.sample_list):])
+        df = self.df[self._group_cols(self.sample_list)].join(matched_df.drop(columns='N_SAMPLES'), how='left')
+        for name in sample_list[len(self.sample_list):]:
+            df[name] = df[name].fillna(0).astype(np.uint8)
+        df['N_SAMPLES'] = df['N_SAMPLES'] + matched_df['N_SAMPLES'].reindex(df.index, fill_value=0)
+
+        self.sample_list = sample_list
+        new_groups_df = self._make_group_df(new_groups)
+        share_categories([df, new_groups_df], ["%s_SV_DETAILS" % name for name in sample_list])
+        share_categories([df, new_groups_df], ["%s_GENOTYPE" % name for name in sample_list])
+        self.df = pd.concat([df, new_groups_df])[group_cols].sort_index()
+
+        new_gene_df = self._make_gene_df(new_groups, gene_df)
+        share_categories([self.gene_df, new_gene_df], ['Ensembl Gene ID'])
+        self.gene_df = pd.concat([self.gene_df, new_gene_df]).sort_index(kind='mergesort')
+
+        self.ann_df = pd.concat([self.ann_df, ann_df])
+        self.ann_df = self.ann_df[~self.ann_df.index.duplicated(keep='first')]
+
+        self.bedtool = self.make_ref_bedtool()
+        self.df = self.df.join(self.ann_df, how='left')
+
+    def _group_cols(self, sample_list):
+        return ['N_SAMPLES'] + sample_list + ["%s_SV_DETAILS" % name for name in sample_list] + ["%s_GENOTYPE" % name for name in sample_list]
+
+    def _parse_sv_vcfs(self, vcf_paths, ann_fields=[], threads=1, cache_dir=None, cache_size=DEFAULT_CACHE_SIZE):
         '''
-        def split_Ensembl_ids(id_list):
-            new_list = []
-            for id in id_list:
-                if '-' in id:
-                    new_list.extend(id.split('-'))
-                elif '&' in id:
-                    new_list.extend(id.split('&'))
-                else:
-                    new_list.append(id)
-            return new_list
+            Merge all SV interval data from multiple vcf's in to a single list of intervals
 
+            Implementation:
+                Each vcf is parsed in to a DataFrame by parse_sv_vcf, in a pool of worker processes when threads > 1.
+                With a cache_dir, parses are cached on disk and reused while the vcf content and parser options are unchanged.
+                Results are merged in the order of vcf_paths, then a tuple containing each row is collected.
+                Each row is numbered, the number is part of its interval tuple and keys the merged table of Ensembl gene ids
+        '''
         intervals = []
+        gene_dfs = []
         sample_names = []
         ann_dfs = []
+        n_rows = 0
 
         index_fields = list(self.index_cols.keys()) #CHR POS STOP needs to be first 3 columns for creation of BedTool instance
-        sample_sv_fields = index_fields + ['calldata/GT', 'variants/ANN_Gene_ID', 'samples']
-        parse_fields = list(set(sample_sv_fields + ann_fields))
+        sample_sv_fields = index_fields + ['calldata/GT', 'row', 'samples']
 
-        for vcf_path in vcf_paths:
-            vcf_dict = allel.read_vcf(vcf_path, ['*'], numbers={'ANN': 1000}, transformers=allel.ANNTransformer()) #use read_vcf because genotype field is not picked up with vcf_to_dataframe
+        if threads > 1 and len(vcf_paths) > 1:
+            with ProcessPoolExecutor(max_workers=min(threads, len(vcf_paths))) as pool:
+                parsed_vcfs = list(pool.map(parse_sv_vcf_cached, vcf_paths, repeat(index_fields), repeat(ann_fields), repeat(cache_dir), repeat(cache_size)))
+        else:
+            parsed_vcfs = [parse_sv_vcf_cached(vcf_path, index_fields, ann_fields, cache_dir, cache_size) for vcf_path in vcf_paths]
 
-            assert len(vcf_dict['samples']) == 1, "%s contains 0 or more than 1 sample: %s" % (vcf_path, str(vcf_dict['samples']))
-            name = vcf_dict.pop('samples')[0]
+        for name, df, gene_df in parsed_vcfs:
             sample_names.append(name)
-            
-            # if 'chr' in CHROM field, remove
-            vcf_dict['variants/CHROM'] = [chrom.strip('chr') for chrom in vcf_dict['variants/CHROM']]
-
-            # if 'chr' in CHROM field, remove
-            vcf_dict['variants/CHROM'] = [chrom.strip('chr') for chrom in vcf_dict['variants/CHROM']]
-            
-            # drop un-needed fields from vcf, cannot pass in parse_fields to read_vcf() because ANN_gene_id is unknown until ANNTransformer runs
-            for key in list(vcf_dict.keys()):
-                if key not in parse_fields:
-                    vcf_dict.pop(key)
-
-            # remove empty strings, split on delimited characters, then join using comma
-            vcf_dict['variants/ANN_Gene_ID'] = [list(filter(None, ann)) for ann in vcf_dict['variants/ANN_Gene_ID']] #by default, specifying numbers=1000 creates 1000 elements, with most being empty
-            vcf_dict['variants/ANN_Gene_ID'] = [split_Ensembl_ids(id_list) if any('&' in id for id in id_list) or any('-' in id for id in id_list) else id_list for id_list in vcf_dict['variants/ANN_Gene_ID']]
-            vcf_dict['variants/ANN_Gene_ID'] = [','.join(list(set(id_list))) if isinstance(id_list, list) else id_list for id_list in vcf_dict['variants/ANN_Gene_ID']]
-
-            vcf_dict['calldata/GT'] = np.array(['HET' if 0 in gt and 1 in gt else 'HOM' for gt in vcf_dict.pop('calldata/GT')])
-
-            df = pd.DataFrame(vcf_dict)
-            df['samples'] = name
-
-            # workaround for START > END so BedTool doesn't freak out using MalformedBedError
-            # START > END is the case for TRV, INV
-            s = df['variants/END'] < df['variants/POS']
-            df.loc[s, ['variants/END','variants/POS']] = df.loc[s, ['variants/POS','variants/END']].values
-            df['variants/POS'] = df['variants/POS'].astype(int)
-            df['variants/END'] = df['variants/END'].astype(int)
-            df = df.drop_duplicates()
-
-            intervals.extend(df[sample_sv_fields].itertuples(index=False))
+            df['row'] = np.arange(n_rows, n_rows + len(df))
+            intervals.extend(df[sample_sv_fields].itertuples(index=False, name=None))
+
+            gene_dfs.append(pd.DataFrame({'row': gene_df['record'].values + n_rows, 'Ensembl Gene ID': gene_df['Ensembl Gene ID'].values}))
+            n_rows += len(df)
 
             if ann_fields:
                 ann_dfs.append(df[index_fields + ann_fields])
@@ -103,54 +372,77 @@ class SVGrouper:
         ann_df = pd.concat(ann_dfs).astype(str).rename(columns=self.index_cols).set_index(list(self.index_cols.values())) if ann_fields else pd.DataFrame()
         ann_df = ann_df[~ann_df.index.duplicated(keep='first')] #annotations for the same SV in a vcf can have slighly differing fields (ex. SVSCORE_MEAN)
 
-        for i in intervals:
-            print(i)
+        gene_df = pd.concat(gene_dfs, ignore_index=True) if gene_dfs else pd.DataFrame(columns=['row', 'Ensembl Gene ID'])
+        gene_df['Ensembl Gene ID'] = gene_df['Ensembl Gene ID'].astype('category')
 
-        return BedTool(intervals), ann_df, sample_names
+        return intervals, gene_df, ann_df, sample_names
 
-    def _group_sv(self, bedtool, reciprocal_overlap=0.5):
-        already_grouped_intervals = set()
+    def _group_func(self, cluster_mode):
+        assert cluster_mode in CLUSTER_MODES, "Unknown cluster mode %s, expected one of %s" % (cluster_mode, CLUSTER_MODES)
+        return cluster_intervals if cluster_mode == 'transitive' else group_intervals
 
-        for l in bedtool.intersect(bedtool, wa=True, wb=True, F=reciprocal_overlap, f=reciprocal_overlap):
+    def _group_sv(self, intervals, gene_df, reciprocal_overlap=0.5, threads=1, shard_by_chrom=False, cluster_mode='first'):
+        '''
+            Group the intervals and build self.df and self.gene_df
 
-            ref_chr, ref_start, ref_end, ref_svtype, ref_gt, ref_genes, ref_name, \
-            samp_chr, samp_start, samp_end, samp_svtype, samp_gt, samp_genes, samp_name = l
+            With the 'first' cluster_mode an interval joins the group of the first interval it overlaps (group_intervals), with the 'transitive'
+            cluster_mode groups are the connected components of the overlap graph (cluster_intervals)
 
-            ref_interval = (ref_chr, ref_start, ref_end, ref_svtype)
-            samp_interval = (samp_chr, samp_start, samp_end, samp_svtype, samp_gt, samp_name)
+            Implementation:
+                Grouping by reciprocal overlap never crosses chromosomes. With shard_by_chrom, the intervals are partitioned by CHROM and each
+                shard is grouped in a pool of worker processes. The sorted groups of each shard are concatenated in CHROM order,
+                which is the order a sort of all groups gives, so the result is identical to grouping all intervals at once
+        '''
+        group_func = self._group_func(cluster_mode)
 
-            if (samp_interval not in already_grouped_intervals) and (ref_svtype == samp_svtype):
-                self._add_interval(ref_interval, ref_genes, samp_interval)
-                already_grouped_intervals.add(samp_interval)
-        
-        self.df.sort_index(inplace=True)
+        if shard_by_chrom and threads > 1:
+            shards = defaultdict(list)
+            for interval in intervals:
+                shards[str(interval[0])].append(interval)
 
-    def _add_interval(self, ref_interval, ref_genes, samp_interval):
-        samp_chr, samp_start, samp_end, samp_svtype, samp_gt, samp_name = samp_interval
+            with ProcessPoolExecutor(max_workers=min(threads, len(shards)) or 1) as pool:
+                # submit the largest chromosomes first so the small ones fill in behind them
+                futures = {chrom: pool.submit(group_func, shards[chrom], reciprocal_overlap) for chrom in sorted(shards, key=lambda chrom: len(shards[chrom]), reverse=True)}
+                groups = list(chain.from_iterable(futures[chrom].result() for chrom in sorted(shards)))
+        else:
+            groups = group_func(intervals, reciprocal_overlap)
 
-        #Get reference to row
-        if ref_interval not in self.df.index:
-            #make new row
-            self.df.loc[ref_interval, :] = np.nan
-            row = self.df.loc[ref_interval, :]
-            row['N_SAMPLES'] = 0
-            row['Ensembl Gene ID'] = ref_genes
+        self.df = self._make_group_df(groups)
+        self.gene_df = self._make_gene_df(groups, gene_df)
 
-            for name in self.sample_list:
-                row[name] = 0
-                row["%s_SV_DETAILS" % name] = []
-                row["%s_GENOTYPE" % name] = []
-        else:
-            row = self.df.loc[ref_interval, :]
+    def _make_group_df(self, groups, sample_list=None):
+        '''
+            Build the grouped SV DataFrame, indexed by CHROM, POS, END, SVTYPE, from the sorted (reference interval, group) pairs made by group_intervals or cluster_intervals.
+            Columns are made for the samples in sample_list, by default all samples
+
+            The table is kept compact: N_SAMPLES and the per-sample membership flags are small unsigned integers, and the _SV_DETAILS and
+            _GENOTYPE columns are categoricals whose codes point in to one pool of detail strings and one pool of genotypes.
+            A sample missing from a group has no details or genotypes (NaN), which write() outputs as '.'
+        '''
+        index_names = list(self.index_cols.values())
+        sample_list = self.sample_list if sample_list is None else sample_list
+        ref_intervals = [ref for ref, group in groups]
+        members = [group[1] for ref, group in groups]
+
+        data = {'N_SAMPLES': np.array([len(member) for member in members], dtype=np.uint16)}
+        for name in sample_list:
+            data[name] = np.array([name in member for member in members], dtype=np.uint8)
+        data.update(pooled_categoricals({"%s_SV_DETAILS" % name: [', '.join(member[name][0]) if name in member else None for member in members] for name in sample_list}))
+        data.update(pooled_categoricals({"%s_GENOTYPE" % name: [', '.join(member[name][1]) if name in member else None for member in members] for name in sample_list}))
+
+        index = pd.MultiIndex.from_arrays(list(zip(*ref_intervals)) if ref_intervals else [[]] * len(index_names), names=index_names)
+        return pd.DataFrame(data, index=index)[self._group_cols(sample_list)]
+
+    def _make_gene_df(self, groups, gene_df):
+        '''
+            Build the exploded table of Ensembl gene ids of each group, indexed like the grouped SV DataFrame.
+            The genes of a group are those of its reference interval
+        '''
+        index_names = list(self.index_cols.values())
+        ref_rows = pd.DataFrame([ref + (group[0],) for ref, group in groups], columns=index_names + ['row'])
 
-        #Set values for row
-        if row[samp_name] == 0:
-            row['N_SAMPLES'] += 1
-            row[samp_name] = 1
+        return ref_rows.merge(gene_df, on='row').drop(columns='row').set_index(index_names)
 
-        row["%s_SV_DETAILS" % samp_name].append('{}:{}-{}:{}'.format(samp_chr, samp_start, samp_end, samp_svtype))
-        row["%s_GENOTYPE" % samp_name].append(samp_gt)
-    
     def write(self, outfile_name):
         self.df.to_csv(outfile_name, sep='\t', encoding='utf-8', na_rep='.')
 
@@ -1,2 +1,3 @@
 from .SVGrouper import SVGrouper
-from .SVAnnotator import SVAnnotator
\ No newline at end of file
+from .SVAnnotator import SVAnnotator
+from .instrument import StageRecorder
\ No newline at end of file
@@ -0,0 +1,85 @@
+import hashlib
+import os
+import pandas as pd
+import tempfile
+
+DEFAULT_CACHE_SIZE = 10 * 1024 ** 3
+
+def file_digest(path, chunk_size=1024 ** 2):
+    '''
+        SHA-256 of the content of a file
+    '''
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+class FileCache:
+    '''
+        Directory of pickled objects keyed by content, bounded to max_bytes.
+
+        Keys are made with make_key from anything that determines the cached object (file digests, options, a format version).
+        Entries are written atomically, so several processes can share a cache directory. When the directory grows over max_bytes,
+        the least recently used entries are evicted, a hit refreshes the modification time of its entry
+    '''
+    suffix = '.pkl'
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_CACHE_SIZE):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(*parts):
+        return hashlib.sha256(repr(parts).encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + self.suffix)
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            value = pd.read_pickle(path)
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        except Exception as e: # corrupt entry, or pickled by a version of the code that no longer loads it
+            print('Discarding unreadable cache entry %s: %r' % (path, e))
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            return None
+        return value
+
+    def put(self, key, value):
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        os.close(fd)
+        try:
+            pd.to_pickle(value, tmp_path)
+            os.replace(tmp_path, self.path(key))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(self.suffix):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
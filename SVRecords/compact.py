@@ -0,0 +1,31 @@
+import numpy as np
+import pandas as pd
+from itertools import chain
+
+def pooled_categoricals(columns):
+    '''
+        Encode lists of strings as Categoricals that share one pool of categories, so each cell is an integer offset in to the pool.
+        None marks a missing value.
+
+        columns maps column names to lists of values, returns a dict mapping the same names to Categoricals
+    '''
+    pool = {}
+    codes = {}
+
+    for name, values in columns.items():
+        codes[name] = np.fromiter((-1 if value is None else pool.setdefault(value, len(pool)) for value in values), dtype=np.int32, count=len(values))
+
+    dtype = pd.CategoricalDtype(list(pool))
+    return {name: pd.Categorical.from_codes(codes[name], dtype=dtype) for name in columns}
+
+def share_categories(dfs, cols):
+    '''
+        Give the categorical columns cols of every DataFrame in dfs the same categories, in place, so that they can be concatenated
+        without being converted back to strings
+    '''
+    categories = pd.Index(list(chain.from_iterable(df[col].cat.categories for df in dfs for col in cols if col in df.columns))).unique()
+
+    for df in dfs:
+        for col in cols:
+            if col in df.columns:
+                df[col] = df[col].cat.set_categories(categories)
@@ -0,0 +1,111 @@
+import numpy as np
+import os
+import pandas as pd
+import tempfile
+from .overlap import infer_like_read_csv, reciprocal_overlap_join
+
+GNOMAD_INDEX_VERSION = 1 #increment when the layout of the index changes, to reject old index files
+GNOMAD_COLS = ['CHROM', 'START', 'END', 'NAME', 'SVTYPE', 'AN', 'AC', 'AF', 'N_HOMREF', 'N_HET', 'N_HOMALT', 'FREQ_HOMREF', 'FREQ_HET', 'FREQ_HOMALT', 'POPMAX_AF']
+GNOMAD_VALUE_COLS = [col for col in GNOMAD_COLS if col not in ('CHROM', 'SVTYPE')]
+
+def typed_column(values):
+    '''
+        Store a column of strings as int64 or float64 when every value prints back to the same string, otherwise as fixed width strings
+    '''
+    values = np.asarray(values, dtype=str)
+    for dtype in np.int64, np.float64:
+        try:
+            typed = values.astype(dtype)
+        except (ValueError, OverflowError):
+            continue
+        if np.array_equal(typed.astype(str), values):
+            return typed
+    return values
+
+def build_gnomad_index(gnomad_bed):
+    '''
+        Read a gnomAD-SV BED in to arrays for each CHROM and SVTYPE, sorted by START.
+        'ORDER' holds the line of each SV in the BED, which orders the SVs matched to one interval like bedtools does
+
+        Returns a dict mapping (CHROM, SVTYPE) to a dict of column arrays
+    '''
+    gnomad_df = pd.read_csv(gnomad_bed, sep='\t', dtype='str').fillna('nan')
+    gnomad_df.columns = gnomad_df.columns.str.replace('#', '')
+    gnomad_df.columns = gnomad_df.columns.str.strip()
+    gnomad_df = gnomad_df[GNOMAD_COLS]
+    gnomad_df['ORDER'] = np.arange(len(gnomad_df))
+    gnomad_df['START_INT'] = gnomad_df['START'].astype(np.int64)
+    gnomad_df = gnomad_df.sort_values(['CHROM', 'SVTYPE', 'START_INT'], kind='mergesort')
+
+    # columns are typed over the whole table so that every CHROM and SVTYPE has the same dtypes
+    columns = {col: typed_column(gnomad_df[col].values) for col in GNOMAD_VALUE_COLS}
+    columns['ORDER'] = gnomad_df['ORDER'].values
+
+    index = {}
+    for key, rows in gnomad_df.reset_index(drop=True).groupby(['CHROM', 'SVTYPE'], sort=False).indices.items():
+        index[key] = {col: values[rows] for col, values in columns.items()}
+    return index
+
+def save_gnomad_index(index, index_path):
+    '''
+        Save an index made by build_gnomad_index as an uncompressed .npz, with one array per CHROM, SVTYPE and column named CHROM/SVTYPE/column.
+        The file is replaced atomically, so reports reading it never see a partly written index
+    '''
+    arrays = {'version': np.array(GNOMAD_INDEX_VERSION)}
+    for (chrom, svtype), columns in index.items():
+        for col, values in columns.items():
+            arrays['%s/%s/%s' % (chrom, svtype, col)] = values
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(index_path)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+        os.chmod(tmp_path, 0o644) #mkstemp makes the file readable by its owner only, the index is shared
+        os.replace(tmp_path, index_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def load_gnomad_index(index_path, chroms=None):
+    '''
+        Load an index saved by save_gnomad_index. Arrays are read lazily from the .npz, so with chroms only those chromosomes are read
+    '''
+    index = {}
+    with np.load(index_path, allow_pickle=False) as npz:
+        assert int(npz['version']) == GNOMAD_INDEX_VERSION, "%s was made by an incompatible version of build_gnomad_index" % index_path
+
+        for key in npz.files:
+            if key == 'version':
+                continue
+            chrom, svtype, col = key.rsplit('/', 2)
+            if chroms is None or chrom in chroms:
+                index.setdefault((chrom, svtype), {})[col] = npz[key]
+    return index
+
+def match_gnomad(index, chroms, starts, ends, svtypes, reciprocal_overlap=0.5):
+    '''
+        Match intervals to the gnomAD SVs of the same CHROM and SVTYPE that they overlap reciprocally by reciprocal_overlap
+
+        Returns the positions of the matched intervals and a DataFrame with the columns of the gnomAD SV matched to each, as strings formatted
+        like the columns of a bedtools intersect output read with pandas, ordered by interval then by line of the gnomAD-SV BED
+    '''
+    keys = [key for key in index if len(index[key]['ORDER'])]
+    if not keys:
+        return np.array([], dtype=np.int64), pd.DataFrame(columns=GNOMAD_COLS)
+
+    sizes = [len(index[key]['ORDER']) for key in keys]
+    b_chroms = np.repeat([chrom for chrom, svtype in keys], sizes)
+    b_svtypes = np.repeat([svtype for chrom, svtype in keys], sizes)
+    b_starts = np.concatenate([index[key]['START'] for key in keys]).astype(np.int64)
+    b_ends = np.concatenate([index[key]['END'] for key in keys]).astype(np.int64)
+    b_order = np.concatenate([index[key]['ORDER'] for key in keys])
+
+    pairs_a, pairs_b = reciprocal_overlap_join(chroms, starts, ends, svtypes, b_chroms, b_starts, b_ends, b_svtypes, reciprocal_overlap)
+    order = np.lexsort((b_order[pairs_b], pairs_a))
+    pairs_a, pairs_b = pairs_a[order], pairs_b[order]
+
+    matches = {'CHROM': b_chroms[pairs_b], 'SVTYPE': b_svtypes[pairs_b]}
+    for col in GNOMAD_VALUE_COLS:
+        matches[col] = infer_like_read_csv(np.concatenate([index[key][col] for key in keys])[pairs_b].astype(str)).astype(str)
+
+    return pairs_a, pd.DataFrame(matches)[GNOMAD_COLS]
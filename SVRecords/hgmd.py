@@ -0,0 +1,26 @@
+import os
+import sqlite3
+from urllib.request import pathname2url
+
+def index_hgmd(hgmd_db):
+    '''
+        Index the gene columns of the HGMD tables queried by SVAnnotator.hgmd_table. Done once with crg.build_sv_reference.py,
+        as reports open the database read-only
+    '''
+    conn = sqlite3.connect(hgmd_db)
+    try:
+        conn.executescript('''
+            CREATE INDEX IF NOT EXISTS GROSDEL_GENE ON GROSDEL (gene COLLATE NOCASE);
+            CREATE INDEX IF NOT EXISTS GROSINS_GENE ON GROSINS (gene COLLATE NOCASE, type);
+            CREATE INDEX IF NOT EXISTS ALLGENES_GENE ON ALLGENES (gene);
+        ''')
+    except sqlite3.OperationalError as e:
+        print('Could not index %s, reports will query it without indexes: %s' % (hgmd_db, e))
+    finally:
+        conn.close()
+
+def connect_hgmd_read_only(hgmd_db):
+    '''
+        Open the HGMD database without write access, so reports never modify the shared file. Temporary tables can still be created
+    '''
+    return sqlite3.connect('file:%s?mode=ro' % pathname2url(os.path.abspath(hgmd_db)), uri=True)
@@ -0,0 +1,65 @@
+import cProfile
+import json
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    '''
+        Peak resident set size so far in MB, of this process or with resource.RUSAGE_CHILDREN of its largest finished child
+    '''
+    maxrss = resource.getrusage(who).ru_maxrss
+    return maxrss / 1024 ** 2 if sys.platform == 'darwin' else maxrss / 1024 # ru_maxrss is in bytes on macOS, KB on Linux
+
+def children_cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+class StageRecorder:
+    '''
+        Records the wall time, CPU time, peak RSS delta and rows in and out of each stage of a report, and writes them as a JSON sidecar.
+
+        CPU time is split between this process and its finished children (worker processes, AnnotSV). The peak RSS delta is how much
+        the peak RSS of the process grew during the stage, so it is 0 for stages that stay below the peak of an earlier one.
+        The stage named profile_stage is also run under cProfile, its stats are dumped to profile_path
+    '''
+    def __init__(self, profile_stage=None, profile_path=None):
+        self.stages = []
+        self.profile_stage = profile_stage
+        self.profile_path = profile_path
+
+    @contextmanager
+    def stage(self, name, rows_in=None):
+        '''
+            Record the stage run in the with block. Set 'rows_out', and 'rows_in' if it is only known once the stage has run, in the yielded record before the block ends
+        '''
+        record = {'stage': name, 'rows_in': rows_in, 'rows_out': None}
+        profiler = cProfile.Profile() if name == self.profile_stage else None
+        wall, cpu, children_cpu, peak_rss = time.perf_counter(), time.process_time(), children_cpu_seconds(), peak_rss_mb()
+
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield record
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(self.profile_path)
+                print('Wrote cProfile stats of %s to %s' % (name, self.profile_path))
+
+            record.update(
+                wall_seconds=time.perf_counter() - wall,
+                cpu_seconds=time.process_time() - cpu,
+                children_cpu_seconds=children_cpu_seconds() - children_cpu,
+                peak_rss_delta_mb=peak_rss_mb() - peak_rss,
+            )
+            self.stages.append(record)
+
+    def write(self, sidecar_path, **fields):
+        '''
+            Write the stages recorded so far to sidecar_path as JSON, with fields and the peak RSS of the process and its children
+        '''
+        report = dict(fields, peak_rss_mb=peak_rss_mb(), children_peak_rss_mb=peak_rss_mb(resource.RUSAGE_CHILDREN), stages=self.stages)
+        with open(sidecar_path, 'w') as f:
+            json.dump(report, f, indent=4)
@@ -0,0 +1,155 @@
+import numpy as np
+import pandas as pd
+
+MAX_CANDIDATE_PAIRS = 2000000
+READ_CSV_NA_VALUES = ['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN', '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null']
+
+def reciprocal_overlap_pairs(chroms, starts, ends, svtypes, reciprocal_overlap=0.5):
+    '''
+        Find all pairs of intervals with the same CHROM and SVTYPE that overlap each other by at least reciprocal_overlap,
+        the equivalent of a 'bedtools intersect -a x -b x -f reciprocal_overlap -F reciprocal_overlap -wa -wb' self-join
+        followed by dropping the pairs with differing SVTYPEs. Every interval is paired with itself.
+
+        Returns two arrays of positional indices (a, b), ordered by a then b, i.e. in the order of the input intervals
+    '''
+    return reciprocal_overlap_join(chroms, starts, ends, svtypes, chroms, starts, ends, svtypes, reciprocal_overlap)
+
+def reciprocal_overlap_join(a_chroms, a_starts, a_ends, a_svtypes, b_chroms, b_starts, b_ends, b_svtypes, reciprocal_overlap=0.5):
+    '''
+        Find all pairs of an interval from a and an interval from b with the same CHROM and SVTYPE that overlap each other by at least reciprocal_overlap
+
+        Intervals are BED-style (0-based, half-open). As in bedtools, zero-length intervals (e.g. insertions) are padded
+        by one base on each side before overlaps are computed.
+
+        Implementation:
+            Sort-and-sweep over NumPy arrays for each CHROM and SVTYPE. For an interval i of a, a partner j must start before i ends and,
+            because the overlap cannot be larger than i, j can be at most len(i) / reciprocal_overlap long, which bounds how far
+            to the left of i it can start. Candidates are the sorted starts of b between those two bounds, found with np.searchsorted,
+            and are then filtered on their exact overlap fractions.
+
+        Returns two arrays of positional indices (a, b), ordered by a then b
+    '''
+    a_starts, a_ends = pad_zero_length(a_starts, a_ends)
+    b_starts, b_ends = pad_zero_length(b_starts, b_ends)
+
+    pairs_a, pairs_b = [], []
+    b_groups = _group_indices(b_chroms, b_svtypes)
+
+    for key, a_idx in _group_indices(a_chroms, a_svtypes).items():
+        if key not in b_groups:
+            continue
+        b_idx = b_groups[key]
+        b_idx = b_idx[np.argsort(b_starts[b_idx], kind='stable')]
+        a, b = _sweep(a_starts[a_idx], a_ends[a_idx], b_starts[b_idx], b_ends[b_idx], reciprocal_overlap)
+        pairs_a.append(a_idx[a])
+        pairs_b.append(b_idx[b])
+
+    if not pairs_a:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+
+    pairs_a, pairs_b = np.concatenate(pairs_a), np.concatenate(pairs_b)
+    order = np.lexsort((pairs_b, pairs_a))
+    return pairs_a[order], pairs_b[order]
+
+def pad_zero_length(starts, ends):
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+
+    zero_length = starts == ends
+    return np.where(zero_length, starts - 1, starts), np.where(zero_length, ends + 1, ends)
+
+def _group_indices(chroms, svtypes):
+    return pd.DataFrame({'CHROM': np.asarray(chroms, dtype=str), 'SVTYPE': np.asarray(svtypes, dtype=str)}).groupby(['CHROM', 'SVTYPE'], sort=False).indices
+
+def _sweep(a_starts, a_ends, b_starts, b_ends, reciprocal_overlap):
+    '''
+        Reciprocal overlap join of intervals a with intervals b sorted by start, all on one CHROM with one SVTYPE
+    '''
+    a_lengths = a_ends - a_starts
+    b_lengths = b_ends - b_starts
+    if reciprocal_overlap > 0:
+        lo = np.searchsorted(b_starts, a_starts - a_lengths / reciprocal_overlap, side='left')
+    else:
+        lo = np.zeros(len(a_starts), dtype=np.int64)
+    hi = np.searchsorted(b_starts, a_ends, side='left')
+    counts = hi - lo
+
+    pairs_a, pairs_b = [], []
+    # bound the size of the candidate arrays, very large SVs can have many candidates
+    n_chunks = max(1, int(counts.sum() // MAX_CANDIDATE_PAIRS))
+    for rows in np.array_split(np.arange(len(a_starts)), n_chunks):
+        chunk_counts = counts[rows]
+        a = np.repeat(rows, chunk_counts)
+        offsets = np.arange(len(a)) - np.repeat(np.cumsum(chunk_counts) - chunk_counts, chunk_counts)
+        b = np.repeat(lo[rows], chunk_counts) + offsets
+
+        overlap = np.minimum(a_ends[a], b_ends[b]) - np.maximum(a_starts[a], b_starts[b])
+        keep = (overlap > 0) & (overlap / a_lengths[a] >= reciprocal_overlap) & (overlap / b_lengths[b] >= reciprocal_overlap)
+        pairs_a.append(a[keep])
+        pairs_b.append(b[keep])
+
+    return np.concatenate(pairs_a), np.concatenate(pairs_b)
+
+def intersect_intervals(intervals, reciprocal_overlap=0.5):
+    '''
+        In-process replacement for BedTool(intervals).intersect(BedTool(intervals), wa=True, wb=True, f=reciprocal_overlap, F=reciprocal_overlap)
+        that only reports pairs with the same SVTYPE. No temporary files are written and no bedtools process is spawned.
+
+        intervals is a list of tuples starting with CHROM, START, END, SVTYPE. Each yielded line is the concatenation of the two
+        overlapping tuples with every field as a string, like the fields of a pybedtools Interval
+    '''
+    rows = [tuple(str(field) for field in interval) for interval in intervals]
+    if not rows:
+        return
+
+    chroms, starts, ends, svtypes = zip(*(row[:4] for row in rows))
+    pairs_a, pairs_b = reciprocal_overlap_pairs(chroms, np.array(starts).astype(np.int64), np.array(ends).astype(np.int64), svtypes, reciprocal_overlap)
+
+    for a, b in zip(pairs_a, pairs_b):
+        yield rows[a] + rows[b]
+
+def infer_like_read_csv(values):
+    '''
+        Type a column of strings like pd.read_csv does, and so like BedTool.to_dataframe types the columns of a bedtools intersect output:
+        int64 if every value is an integer, float64 if every value is a number or missing, otherwise the strings unchanged
+    '''
+    values = np.asarray(values, dtype=str)
+    try:
+        return values.astype(np.int64)
+    except (ValueError, OverflowError):
+        pass
+    try:
+        return np.where(np.isin(values, READ_CSV_NA_VALUES), 'nan', values).astype(np.float64)
+    except ValueError:
+        return values
+
+def connected_components(n, pairs_a, pairs_b):
+    '''
+        Label the connected components of a graph with n nodes and the edges (pairs_a[i], pairs_b[i]), with a union-find over NumPy arrays
+
+        Implementation:
+            Every node starts as the root of its own set. In each round the roots of the two ends of every edge are linked by hooking the larger
+            root under the smaller one, then paths are compressed by pointer jumping until every node points at its root. Rounds repeat until
+            both ends of every edge have the same root, which takes a logarithmic number of rounds in practice.
+
+        Returns an array with the smallest node of its component for each node
+    '''
+    labels = np.arange(n)
+    pairs_a = np.asarray(pairs_a, dtype=np.int64)
+    pairs_b = np.asarray(pairs_b, dtype=np.int64)
+
+    while len(pairs_a):
+        roots_a, roots_b = labels[pairs_a], labels[pairs_b]
+        linked = roots_a != roots_b
+        if not linked.any():
+            break
+        pairs_a, pairs_b, roots_a, roots_b = pairs_a[linked], pairs_b[linked], roots_a[linked], roots_b[linked]
+
+        np.minimum.at(labels, np.maximum(roots_a, roots_b), np.minimum(roots_a, roots_b))
+        while True:
+            jumped = labels[labels]
+            if np.array_equal(jumped, labels):
+                break
+            labels = jumped
+
+    return labels
@@ -0,0 +1,41 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import nullcontext
+
+def run_stage_graph(stages, threads=1, recorder=None, rows_in=None):
+    '''
+        Run a graph of stages, each as soon as the stages it depends on are done, up to threads at a time.
+
+        stages maps the name of each stage to (dependencies, function): function is called with the results of the stages named in dependencies,
+        in that order. With threads=1 the stages run one after the other in the order they are declared. With a StageRecorder, each stage is recorded
+        under its name with rows_in, and the length of its result as rows_out. Stages run in threads, so those that run at once share the process
+        and their CPU time and peak RSS delta overlap
+
+        Returns a dict mapping the name of each stage to its result
+    '''
+    for name, (dependencies, function) in stages.items():
+        for dependency in dependencies:
+            assert dependency in stages, "Stage %s depends on %s, which is not a stage" % (name, dependency)
+
+    def run_stage(name, function, args):
+        with recorder.stage(name, rows_in) if recorder is not None else nullcontext({}) as stage:
+            result = function(*args)
+            stage['rows_out'] = len(result)
+        return result
+
+    results = {}
+    pending = dict(stages)
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as pool:
+        while pending or running:
+            for name, (dependencies, function) in list(pending.items()):
+                if all(dependency in results for dependency in dependencies):
+                    running[pool.submit(run_stage, name, function, [results[dependency] for dependency in dependencies])] = name
+                    del pending[name]
+            assert running, "Stages %s depend on each other" % ', '.join(pending)
+
+            done, not_done = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future)] = future.result()
+
+    return results
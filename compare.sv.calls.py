@@ -5,7 +5,7 @@ import allel
 import numpy as np
 import pandas as pd
 import os
-from pybedtools import BedTool
+from SVRecords.overlap import intersect_intervals
 
 sample_list = []
 
@@ -61,9 +61,9 @@ def combine_vcf_df(vcf_dfs):
 	ann_df.columns = ann_df.columns.str.replace('variants/', '')
 	ann_df = ann_df[["CHROM", "POS", "END", "SVTYPE", "SAMPLE"]]
 
-	return BedTool(list(ann_df.itertuples(index=False, name=None)))
+	return list(ann_df.itertuples(index=False, name=None))
 
-def group_sv(bedtool, reciprocal_overlap):
+def group_sv(intervals, reciprocal_overlap):
 
 	print('Identifying equivalent structural variant calls using a reciprocal overlap of %f' % reciprocal_overlap)
 
@@ -75,7 +75,7 @@ def group_sv(bedtool, reciprocal_overlap):
 
 	master_df = pd.DataFrame(columns=columns).set_index(['CHROM', 'POS', 'END', 'SVTYPE'])
 
-	for l in bedtool.intersect(bedtool, wa=True, wb=True, F=reciprocal_overlap, f=reciprocal_overlap):
+	for l in intersect_intervals(intervals, reciprocal_overlap=reciprocal_overlap):
 
 		ref_chr, ref_start, ref_end, ref_svtype, ref_name, \
 		samp_chr, samp_start, samp_end, samp_svtype, samp_name = l
@@ -120,7 +120,7 @@ if __name__ == "__main__":
 	args = parser.parse_args()
 
 	vcf_dfs = [parse_vcf(vcf) for vcf in args.i]
-	bedtool = combine_vcf_df(vcf_dfs)
+	intervals = combine_vcf_df(vcf_dfs)
 
-	df = group_sv(bedtool, args.r_overlap)
+	df = group_sv(intervals, args.r_overlap)
 	df.to_csv(args.o, sep="\t")
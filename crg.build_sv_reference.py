@@ -0,0 +1,29 @@
+import argparse
+from SVRecords import SVAnnotator
+from SVRecords.gnomad import build_gnomad_index, save_gnomad_index
+from SVRecords.hgmd import index_hgmd
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Builds the gene reference annotations from the ExAC, OMIM and BioMart files used by crg.intersect_sv_vcfs.py in to a bundle, which is loaded with its -reference_bundle flag instead of being rebuilt on every run. The bundle does not depend on the family, whose HPO terms are joined when it is loaded, so one bundle is shared by all families. Optionally indexes the gnomAD-SV BED for its -gnomad flag and the HGMD database for its -hgmd flag. Each part is built only when its flags are given')
+    parser.add_argument('-exac', help='ExAC tab delimited file containing gene names and scores', type=str)
+    parser.add_argument('-omim', help='OMIM tab delimited file containing gene names and scores', type=str)
+    parser.add_argument('-biomart', help='TSV file from BiomaRt containing Ensemble gene ID, transcript ID, gene name, MIM gene id, HGNC id, EntrezGene ID', type=str)
+    parser.add_argument('-o', help='Output bundle file name e.g. -o sv.reference.pkl', type=str)
+    parser.add_argument('-threads', help='Number of worker processes used to parse the reference files', type=int, default=1)
+    parser.add_argument('-gnomad', help='BED file from Gnomad containing structural variant coordinates and frequencies across populations', type=str)
+    parser.add_argument('-gnomad_index', help='Output gnomAD-SV index file name, must end in .npz e.g. -gnomad_index gnomad_v2_sv.sites.npz', type=str)
+    parser.add_argument('-hgmd', help='SQL database of HGMD to index in place', type=str)
+    args = parser.parse_args()
+
+    if args.o:
+        assert args.exac and args.omim and args.biomart, "-o needs -exac, -omim and -biomart"
+        SVAnnotator(None, None, None, args.exac, args.omim, args.biomart, reference_bundle=args.o, threads=args.threads)
+
+    if args.gnomad and args.gnomad_index:
+        assert args.gnomad_index.endswith('.npz'), "gnomAD-SV index file name must end in .npz: %s" % args.gnomad_index
+        print('Indexing %s ...' % args.gnomad)
+        save_gnomad_index(build_gnomad_index(args.gnomad), args.gnomad_index)
+
+    if args.hgmd:
+        print('Indexing %s ...' % args.hgmd)
+        index_hgmd(args.hgmd)
@@ -1,88 +1,247 @@
 import argparse
+import json
+import multiprocessing
+import os
 import pandas as pd
-from pathlib import Path
-from SVRecords import SVGrouper, SVAnnotator
+import socket
+import socketserver
+import threading
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from SVRecords import SVGrouper, SVAnnotator, StageRecorder
+from SVRecords.stages import run_stage_graph
+
+REPORT_STAGES = ['load_references', 'group', 'annotate_genes', 'annotate_counts', 'annotsv', 'calc_exons_spanned', 'annotate_gnomad', 'annotate_hgmd', 'calc_exon_boundaries', 'join_annotations', 'finalize', 'write']
+# reference data loaded by the worker started by serve and its report options, inherited by the processes that run its jobs
+worker_config = {}
 
 def make_exon_gene_set(protein_coding_genes):
     df = pd.read_csv(protein_coding_genes, sep="\t")
     return(set(df[df.columns[5]]))
 
-def main(protein_coding_genes, exon_bed, hgmd_db, hpo, exac, omim, biomart, gnomad, sv_counts, outfile_name, vcfs):
+def finalize_report(df, numeric):
+    '''
+        Set missing values in the numeric columns to 0, and 'na', '' and 'nan' to '.' in the other string columns.
+        Each group of columns is normalized in one pass over its block, grouped sample columns are compact and only turned in to strings on write
+    '''
+    numeric_df = df[numeric].astype(object)
+    df[numeric] = numeric_df.where(numeric_df.notna(), '0')
+
+    non_numeric = [col for col in df.columns if col not in numeric and df[col].dtype == object]
+    df[non_numeric] = df[non_numeric].replace(['na', '', 'nan'], '.')
+    return df
+
+def main(protein_coding_genes, exon_bed, hgmd_db, hpo, exac, omim, biomart, gnomad, sv_counts, reports, threads=1, shard_by_chrom=False, state=None, cache_dir=None, cache_size=10, cluster_mode='first', reference_bundle=None, annotsv_cache=None, profile=None):
+    '''
+        reports is a list of (name, outfile_name, vcfs), one report is made for each. The gene reference annotations are loaded once for all of them,
+        and the reference files and the annotations of SVs already seen by an earlier report (e.g. the filtered one) are reused from memory.
+
+        The wall time, CPU time, peak RSS delta and rows in and out of each stage of a report are written next to it, to outfile_name.stages.json.
+        Loading the reference data is recorded with the first report. The stage named profile is run under cProfile, its stats are dumped to outfile_name.profile.prof
+    '''
+    assert state is None or len(reports) == 1, "A grouping state file can only be used with a single report"
+    recorders = [StageRecorder(profile, '%s.%s.prof' % (outfile_name, profile) if profile else None) for name, outfile_name, vcfs in reports]
+
+    with recorders[0].stage('load_references') as stage:
+        protein_coding_ENSG = make_exon_gene_set(protein_coding_genes)
+        ann_records = SVAnnotator(exon_bed, hgmd_db, hpo, exac, omim, biomart, reference_bundle=reference_bundle, threads=threads)
+        ann_records.exon_index(exon_bed) # built once before the annotation stages that share it run concurrently
+        stage['rows_out'] = len(ann_records.gene_ref_df)
+
+    make_reports(ann_records, protein_coding_ENSG, exon_bed, hgmd_db, gnomad, sv_counts, reports, recorders, threads=threads, shard_by_chrom=shard_by_chrom, state=state, \
+        cache_dir=cache_dir, cache_size=cache_size, cluster_mode=cluster_mode, annotsv_cache=annotsv_cache)
+
+def make_reports(ann_records, protein_coding_ENSG, exon_bed, hgmd_db, gnomad, sv_counts, reports, recorders, threads=1, shard_by_chrom=False, state=None, cache_dir=None, cache_size=10, cluster_mode='first', annotsv_cache=None):
+    '''
+        Make each of reports, a list of (name, outfile_name, vcfs), from the loaded reference data, and write the stages recorded by its recorder next to it
+    '''
+    for (name, outfile_name, vcfs), stages in zip(reports, recorders):
+        print("Making the %s report ..." % name)
+        make_report(ann_records, protein_coding_ENSG, exon_bed, hgmd_db, gnomad, sv_counts, outfile_name, vcfs, threads=threads, shard_by_chrom=shard_by_chrom, state=state, \
+            cache_dir=cache_dir, cache_size=cache_size, cluster_mode=cluster_mode, annotsv_cache=annotsv_cache, stages=stages)
+        stages.write(outfile_name + '.stages.json', report=name, outfile=outfile_name, vcfs=vcfs, threads=threads)
+
+def run_job(job):
+    '''
+        Make the reports of a job sent to the worker, from the reference data it loaded before forking this process. The HPO terms of the job's hpo file
+        replace those of the file the worker was started with, they are only joined again when it differs from the one of the previous job of this process
+    '''
+    config = dict(worker_config)
+    ann_records, hpo = config.pop('ann_records'), config.pop('hpo')
+    recorders = [StageRecorder() for report in job['reports']]
+
+    with recorders[0].stage('load_references') as stage:
+        ann_records.set_hpo(job.get('hpo', hpo))
+        stage['rows_out'] = len(ann_records.gene_ref_df)
+
+    make_reports(ann_records, reports=job['reports'], recorders=recorders, **config)
+
+def load_worker(reference_options, report_options):
+    '''
+        Load the reference data of the worker in to worker_config, with the report options of its jobs
+    '''
+    print('Loading reference data ...')
+    protein_coding_ENSG = make_exon_gene_set(reference_options['protein_coding_genes'])
+    ann_records = SVAnnotator(reference_options['exon_bed'], reference_options['hgmd_db'], reference_options['hpo'], reference_options['exac'], reference_options['omim'], \
+        reference_options['biomart'], reference_bundle=reference_options['reference_bundle'], threads=report_options['threads'])
+    ann_records.exon_index(reference_options['exon_bed'])
+    ann_records.gnomad_index(reference_options['gnomad'], set())
+    for counts in reference_options['sv_counts'] or []:
+        ann_records.read_counts(counts)
+
+    worker_config.update(report_options, ann_records=ann_records, protein_coding_ENSG=protein_coding_ENSG, exon_bed=reference_options['exon_bed'], \
+        hgmd_db=reference_options['hgmd_db'], hpo=reference_options['hpo'], gnomad=reference_options['gnomad'], sv_counts=reference_options['sv_counts'])
+
+def start_pool(workers, reference_options=None, report_options=None):
+    '''
+        Start the worker processes that run jobs. Without options they are forked, sharing the reference data loaded by serve, which is only safe
+        before the threads of the server start. With options, to restart the pool from a thread of the server, they are forked from a single-threaded
+        fork server instead and each loads the reference data itself
+    '''
+    if reference_options is None:
+        pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'))
+        pool.submit(os.getpid).result() # fork all workers now, jobs do not wait for it
+    else:
+        pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('forkserver'), initializer=load_worker, initargs=(reference_options, report_options))
+    return pool
+
+def serve(socket_path, workers, protein_coding_genes, exon_bed, hgmd_db, hpo, exac, omim, biomart, gnomad, sv_counts, threads=1, cache_dir=None, cache_size=10, cluster_mode='first', reference_bundle=None, annotsv_cache=None):
+    '''
+        Worker mode: load the reference data once, then make the reports of the jobs sent to the Unix socket socket_path by crg.submit_sv_report.py.
+        Each job is a JSON line {"reports": [[name, outfile_name, vcfs], ...], "hpo": hpo}, answered with a JSON line {"status": "done"}
+        or {"status": "failed", "error": traceback} once its reports are written.
+
+        Jobs run in a pool of worker processes, forked after the reference data is loaded so that they share it.
+        Jobs sent while all of them are busy wait for one to be free. If a worker process dies, its job fails and the pool is restarted,
+        with processes that load their own copy of the reference data, see start_pool
+    '''
+    reference_options = dict(protein_coding_genes=protein_coding_genes, exon_bed=exon_bed, hgmd_db=hgmd_db, hpo=hpo, exac=exac, omim=omim, biomart=biomart, \
+        gnomad=gnomad, sv_counts=sv_counts, reference_bundle=reference_bundle)
+    report_options = dict(threads=threads, cache_dir=cache_dir, cache_size=cache_size, cluster_mode=cluster_mode, annotsv_cache=annotsv_cache)
+    load_worker(reference_options, report_options)
+    pool = start_pool(workers) # before the threads of the server start
+    pool_lock = threading.Lock()
+
+    class JobHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            nonlocal pool
+            job = json.loads(self.rfile.readline())
+            print('Received job: %s' % json.dumps(job))
+            job_pool = pool
+            try:
+                job_pool.submit(run_job, job).result()
+                response = {'status': 'done'}
+            except BrokenProcessPool:
+                response = {'status': 'failed', 'error': traceback.format_exc()}
+                with pool_lock:
+                    if pool is job_pool: # not already restarted by another job of the broken pool
+                        print('A worker process died, restarting the pool')
+                        job_pool.shutdown(wait=False)
+                        pool = start_pool(workers, reference_options, report_options)
+            except Exception:
+                response = {'status': 'failed', 'error': traceback.format_exc()}
+            print('Job %s: %s' % (response['status'], json.dumps(job)))
+            self.wfile.write((json.dumps(response) + '\n').encode())
+
+    if os.path.exists(socket_path):
+        with socket.socket(socket.AF_UNIX) as client:
+            assert client.connect_ex(socket_path) != 0, "A worker is already listening on %s" % socket_path
+        os.remove(socket_path)
+
+    with socketserver.ThreadingUnixStreamServer(socket_path, JobHandler) as server:
+        print('Waiting for jobs on %s ...' % socket_path)
+        try:
+            server.serve_forever()
+        finally:
+            pool.shutdown()
+            os.remove(socket_path)
+
+def make_report(ann_records, protein_coding_ENSG, exon_bed, hgmd_db, gnomad, sv_counts, outfile_name, vcfs, threads=1, shard_by_chrom=False, state=None, cache_dir=None, cache_size=10, cluster_mode='first', annotsv_cache=None, stages=None):
+    stages = StageRecorder() if stages is None else stages
     SVScore_cols = ['variants/SVLEN', 'variants/SVSCORESUM', 'variants/SVSCOREMAX', 'variants/SVSCORETOP5', 'variants/SVSCORETOP10', 'variants/SVSCOREMEAN',]
     MetaSV_col = 'variants/NUM_SVTOOLS'
     HPO_cols = [ "N_UNIQUE_HPO_TERMS", "HPO Features", "N_GENES_IN_HPO", "Genes in HPO" ]
     Protein_coding_genes_col = "Protein-coding Ensembl Gene ID"
-    protein_coding_ENSG = make_exon_gene_set(protein_coding_genes)
 
-    print("Grouping like structural variants ...")
-    sv_records = SVGrouper(vcfs, ann_fields=SVScore_cols + [MetaSV_col])
+    with stages.stage('group') as stage:
+        if state and os.path.isfile(state):
+            print("Adding structural variants to the groups in %s ..." % state)
+            sv_records = SVGrouper.from_state(state)
+            sv_records.add_vcfs(vcfs, threads=threads, cache_dir=cache_dir, cache_size=int(cache_size * 1024 ** 3), cluster_mode=cluster_mode)
+        else:
+            print("Grouping like structural variants ...")
+            sv_records = SVGrouper(vcfs, ann_fields=SVScore_cols + [MetaSV_col], threads=threads, shard_by_chrom=shard_by_chrom, cache_dir=cache_dir, cache_size=int(cache_size * 1024 ** 3), cluster_mode=cluster_mode)
+        if state:
+            sv_records.save_state(state)
+        stage['rows_in'] = sv_records.n_parsed_intervals
+        stage['rows_out'] = len(sv_records.df)
     sample_cols = [ col for col in sv_records.df.columns if col != MetaSV_col ]
     sample_genotype_cols = [col for col in sample_cols if col.endswith('_GENOTYPE')]
 
     print("Identifying protein coding genes ...")
-    sv_records.df['Protein-coding Ensembl Gene ID'] = sv_records.df['Ensembl Gene ID'].apply(lambda gene_list: [gene for gene in gene_list if gene in protein_coding_ENSG])
+    protein_coding_gene_df = sv_records.gene_df[sv_records.gene_df['Ensembl Gene ID'].isin(protein_coding_ENSG)].rename(columns={'Ensembl Gene ID': Protein_coding_genes_col})
 
     print('Annotating structural variants ...')
-    ann_records = SVAnnotator(exon_bed, hgmd_db, hpo, exac, omim, biomart)
-    sv_records.df = ann_records.annotate_genes(sv_records.df, Protein_coding_genes_col)
-
-    for sv_count in sv_counts:
-        prefix = Path(sv_count).stem
-        sv_records.df = ann_records.annotate_counts(sv_count, sv_records, prefix=prefix)
-    
-    sv_records.df = ann_records.annotsv(sv_records.df)
-    sv_records.df = ann_records.calc_exons_spanned(sv_records.df, exon_bed)
-    sv_records.df = ann_records.annotate_gnomad(gnomad, sv_records)
-    sv_records.df = ann_records.annotate_hgmd(hgmd_db, sv_records.df)
-    ann_records.add_decipher_link(sv_records.df)
-    sv_records.df = ann_records.calc_exon_boundaries(sv_records.df.reset_index(), exon_bed)
-
-    if not set(HPO_cols).issubset(set(sv_records.df.columns)):
-        for col in HPO_cols:
-            sv_records.df[col] = "na"
-
-    # format and rearrange the columns
-    sv_records.df = sv_records.df[ [col for col in sample_cols if col not in set(SVScore_cols + sample_genotype_cols + ['N_SAMPLES', 'Ensembl Gene ID']) ] + \
-    [ 'variants/SVLEN', ] + \
-    [ MetaSV_col ] + \
-    [ Protein_coding_genes_col ] + \
-    [ "BioMart Associated Gene Name", "EXONS_SPANNED", ] + \
-    [ "Genes in HPO", "HPO Features", ] + \
-    [ "Genes in OMIM", "OMIM Phenotypes", "OMIM Inheritance", ] + \
-    [ "N_GENES_IN_HPO", "N_UNIQUE_HPO_TERMS", "N_GENES_IN_OMIM", ] + \
-    [ "Canadian_MSSNG_parent_SVs.Manta.counts", "Canadian_MSSNG_parent_SVs.Manta.counts_SV", "Canadian_MSSNG_parent_SVs.LUMPY.counts", "Canadian_MSSNG_parent_SVs.LUMPY.counts_SV"] + \
-    [ "DGV_GAIN_IDs", "DGV_GAIN_n_samples_with_SV", "DGV_GAIN_n_samples_tested", "DGV_GAIN_Frequency", ] + \
-    [ "DGV_LOSS_IDs", "DGV_LOSS_n_samples_with_SV", "DGV_LOSS_n_samples_tested", "DGV_LOSS_Frequency", ] + \
-    [ "gnomAD_AF", "gnomAD_SV", "gnomAD_AN", "gnomAD_AC", "gnomAD_N_HOMREF", "gnomAD_N_HET", "gnomAD_N_HOMALT", "gnomAD_FREQ_HOMREF", "gnomAD_FREQ_HET", "gnomAD_FREQ_HOMALT", "gnomAD_POPMAX_AF" ] + \
-    [ "DDD_disease", "DDD_mode", "DDD_pmids", ] + \
-    [ "Genes in HGMD", "HGMD disease", "HGMD descr", "HGMD JOURNAL_DETAILS" ] + \
-    [ "ExAC syn_z", "ExAC mis_z", "ExAC lof_z", "ExAC pLI" ] + \
-    [ col for col in SVScore_cols if col != 'variants/SVLEN'] + \
-    [ "nearestLeftExonBoundary", "nearestLeftExonDistance", "nearestRightExonBoundary", "nearestRightExonDistance", ] + \
-    [ "DECIPHER_LINK" ] ]
-    sv_records.df.columns = sv_records.df.columns.str.replace('variants/','')
-    sv_records.df = sv_records.df.drop_duplicates()
-
-    # [ "DDD_SV", "DDD_DUP_n_samples_with_SV", "DDD_DUP_Frequency", "DDD_DEL_n_samples_with_SV", "DDD_DEL_Frequency" ]
-
-    # set missing values in numeric columns to 0, and '.' in non-numeric columns
-    numeric =  [ "N_GENES_IN_HPO", "N_UNIQUE_HPO_TERMS", "N_GENES_IN_OMIM","gnomAD_AF", "gnomAD_AN", "gnomAD_AC", "gnomAD_N_HOMREF", "gnomAD_N_HET", "gnomAD_N_HOMALT", "gnomAD_FREQ_HOMREF", "gnomAD_FREQ_HET", "gnomAD_FREQ_HOMALT", "gnomAD_POPMAX_AF" ]
-    non_numeric = [col for col in sv_records.df.columns if col not in numeric]
-    for col in numeric:
-        sv_records.df[col] = [val if val == val else '0' for val in sv_records.df[col].tolist()]
-    for col in non_numeric:
-        sv_records.df[col] = ['.' if val == 'na' else val for val in sv_records.df[col].tolist()]
-        sv_records.df[col] = ['.' if val == '' else val for val in sv_records.df[col].tolist()]
-        sv_records.df[col] = ['.' if val == 'nan' else val for val in sv_records.df[col].tolist()]
-
-
-    print('Writing results to file ...')
-    sv_records.write(outfile_name)
+    # every annotation is a frame keyed on CHROM, POS, END, SVTYPE, only HGMD depends on another annotation (the gene names)
+    sv_index = sv_records.df.index.unique()
+    annotations = run_stage_graph({
+        'annotate_genes': ([], lambda: ann_records.gene_annotations(sv_records.df, Protein_coding_genes_col, gene_df=protein_coding_gene_df)),
+        'annotate_counts': ([], lambda: ann_records.count_annotations(sv_counts or [], sv_index, threads=threads)),
+        'annotsv': ([], lambda: ann_records.annotsv_annotations(sv_index, annotsv_cache=annotsv_cache, threads=threads)),
+        'calc_exons_spanned': ([], lambda: ann_records.exons_spanned(sv_index, exon_bed)),
+        'annotate_gnomad': ([], lambda: ann_records.gnomad_annotations(gnomad, sv_index)),
+        'annotate_hgmd': (['annotate_genes'], lambda gene_annotations: ann_records.hgmd_annotations(hgmd_db, gene_annotations)),
+        'calc_exon_boundaries': ([], lambda: ann_records.exon_boundaries(sv_index, exon_bed)),
+    }, threads=threads, recorder=stages, rows_in=len(sv_index))
+
+    with stages.stage('join_annotations', len(sv_records.df)) as stage:
+        sv_records.df = sv_records.df.join(list(annotations.values()))
+        ann_records.add_decipher_link(sv_records.df)
+        stage['rows_out'] = len(sv_records.df)
+
+    with stages.stage('finalize', len(sv_records.df)) as stage:
+        if not set(HPO_cols).issubset(set(sv_records.df.columns)):
+            for col in HPO_cols:
+                sv_records.df[col] = "na"
+
+        # format and rearrange the columns
+        sv_records.df = sv_records.df[ [col for col in sample_cols if col not in set(SVScore_cols + sample_genotype_cols + ['N_SAMPLES', 'Ensembl Gene ID']) ] + \
+        [ 'variants/SVLEN', ] + \
+        [ MetaSV_col ] + \
+        [ Protein_coding_genes_col ] + \
+        [ "BioMart Associated Gene Name", "EXONS_SPANNED", ] + \
+        [ "Genes in HPO", "HPO Features", ] + \
+        [ "Genes in OMIM", "OMIM Phenotypes", "OMIM Inheritance", ] + \
+        [ "N_GENES_IN_HPO", "N_UNIQUE_HPO_TERMS", "N_GENES_IN_OMIM", ] + \
+        [ "Canadian_MSSNG_parent_SVs.Manta.counts", "Canadian_MSSNG_parent_SVs.Manta.counts_SV", "Canadian_MSSNG_parent_SVs.LUMPY.counts", "Canadian_MSSNG_parent_SVs.LUMPY.counts_SV"] + \
+        [ "DGV_GAIN_IDs", "DGV_GAIN_n_samples_with_SV", "DGV_GAIN_n_samples_tested", "DGV_GAIN_Frequency", ] + \
+        [ "DGV_LOSS_IDs", "DGV_LOSS_n_samples_with_SV", "DGV_LOSS_n_samples_tested", "DGV_LOSS_Frequency", ] + \
+        [ "gnomAD_AF", "gnomAD_SV", "gnomAD_AN", "gnomAD_AC", "gnomAD_N_HOMREF", "gnomAD_N_HET", "gnomAD_N_HOMALT", "gnomAD_FREQ_HOMREF", "gnomAD_FREQ_HET", "gnomAD_FREQ_HOMALT", "gnomAD_POPMAX_AF" ] + \
+        [ "DDD_disease", "DDD_mode", "DDD_pmids", ] + \
+        [ "Genes in HGMD", "HGMD disease", "HGMD descr", "HGMD JOURNAL_DETAILS" ] + \
+        [ "ExAC syn_z", "ExAC mis_z", "ExAC lof_z", "ExAC pLI" ] + \
+        [ col for col in SVScore_cols if col != 'variants/SVLEN'] + \
+        [ "nearestLeftExonBoundary", "nearestLeftExonDistance", "nearestRightExonBoundary", "nearestRightExonDistance", ] + \
+        [ "DECIPHER_LINK" ] ]
+        sv_records.df.columns = sv_records.df.columns.str.replace('variants/','')
+        sv_records.df = sv_records.df.drop_duplicates()
+
+        # [ "DDD_SV", "DDD_DUP_n_samples_with_SV", "DDD_DUP_Frequency", "DDD_DEL_n_samples_with_SV", "DDD_DEL_Frequency" ]
+
+        numeric =  [ "N_GENES_IN_HPO", "N_UNIQUE_HPO_TERMS", "N_GENES_IN_OMIM","gnomAD_AF", "gnomAD_AN", "gnomAD_AC", "gnomAD_N_HOMREF", "gnomAD_N_HET", "gnomAD_N_HOMALT", "gnomAD_FREQ_HOMREF", "gnomAD_FREQ_HET", "gnomAD_FREQ_HOMALT", "gnomAD_POPMAX_AF" ]
+        sv_records.df = finalize_report(sv_records.df, numeric)
+        stage['rows_out'] = len(sv_records.df)
+
+    with stages.stage('write', len(sv_records.df)) as stage:
+        print('Writing results to file ...')
+        sv_records.write(outfile_name)
+        stage['rows_out'] = len(sv_records.df)
 
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description='Generates a structural variant report in CSV format for clincal research')
-    parser.add_argument('-i', type=str, nargs='+', help='VCF files containing structural variants, e.g. -i 180_230.vcf 180_231.vcf', required=True)
+    parser.add_argument('-i', type=str, nargs='+', help='VCF files containing structural variants, e.g. -i 180_230.vcf 180_231.vcf')
     parser.add_argument('-protein_coding_genes', help='BED file containing protein coding gene regions with their ENSG id\'s', required=True)
     parser.add_argument('-exon_bed', help='BED file containing fixed exon positions', required=True)
     parser.add_argument('-hgmd', help='HGMD Pro database file', required=True, type=str)
@@ -90,13 +249,37 @@ if __name__ == "__main__":
     parser.add_argument('-exac', help='ExAC tab delimited file containing gene names and scores', type=str, required=True)
     parser.add_argument('-omim', help='OMIM tab delimited file containing gene names and scores', type=str, required=True)
     parser.add_argument('-biomart', help='TSV file from BiomaRt containing Ensemble gene ID, transcript ID, gene name, MIM gene id, HGNC id, EntrezGene ID', type=str, required=True)
-    parser.add_argument('-gnomad', help='BED file from Gnomad containing structural variant coordinates and frequencies across populations', type=str, required=True)
+    parser.add_argument('-gnomad', help='BED file from Gnomad containing structural variant coordinates and frequencies across populations, or its index made by crg.build_sv_reference.py (.npz)', type=str, required=True)
     parser.add_argument('-sv_counts', nargs='+', help='List of BED files containing structural variants and their frequencies. Can be used to annotate with various populations and variant callers', required=False)
     parser.add_argument('-overlap', help='Recipricol overlap to group a structural variant by', type=float, default=0.5)
-    parser.add_argument('-o', help='Output file name e.g. -o 180.sv.family.tsv', required=True, type=str)
+    parser.add_argument('-o', help='Output file name e.g. -o 180.sv.family.tsv', type=str)
+    parser.add_argument('-report', nargs='+', action='append', metavar='NAME OUTPUT VCF', help='Name, output file and VCF files of a report, instead of -i and -o. Repeat to make several reports from one load of the reference data, e.g. -report filtered 180.sv.tsv 180_230.vcf.filtered.gz -report unfiltered 180.unfiltered.sv.tsv 180_230.vcf')
+    parser.add_argument('-threads', help='Number of worker processes and threads used: to parse the input VCF files, the reference files and the SV count files, to group the SVs of each chromosome with -shard_by_chrom, for concurrent AnnotSV runs, and for the annotation stages run at once', type=int, default=1)
+    parser.add_argument('-state', help='Grouping state file. If it exists, the VCF files given with -i are added to its groups instead of regrouping all samples. The updated grouping is saved to it', type=str)
+    parser.add_argument('-cache_dir', help='Directory in which to cache parsed VCF files. VCF files are only parsed again when their content changes', type=str)
+    parser.add_argument('-cache_size', help='Maximum size of -cache_dir in GB, least recently used entries are evicted beyond it', type=float, default=10)
+    parser.add_argument('-shard_by_chrom', help='Group structural variants of each chromosome in a separate worker process, uses -threads workers', action='store_true')
+    parser.add_argument('-cluster_mode', help="How structural variants are grouped. 'first': a variant joins the group of the first variant it overlaps. 'transitive': groups are chains of overlapping variants, independent of input order, represented by their medoid breakpoints", choices=['first', 'transitive'], default='first')
+    parser.add_argument('-reference_bundle', help='Gene reference annotation bundle made by crg.build_sv_reference.py. It holds the annotations of the -exac, -omim and -biomart files, which are the same for every family, and is rebuilt when they change. The -hpo terms are joined when it is loaded', type=str)
+    parser.add_argument('-serve', help='Run as a worker that loads the reference data once and makes the reports of the jobs sent to this Unix socket by crg.submit_sv_report.py, instead of making a report from -i and -o', type=str)
+    parser.add_argument('-workers', help='Number of jobs a worker started with -serve makes at once', type=int, default=2)
+    parser.add_argument('-profile', help='Run this stage of the report under cProfile and dump its stats next to the report, to OUTPUT.STAGE.prof', choices=REPORT_STAGES)
+    parser.add_argument('-annotsv_cache', help='SQLite file in which to cache AnnotSV annotations. Only structural variants not yet annotated by the installed AnnotSV version are sent to it', type=str)
     args = parser.parse_args()
 
-    if len(args.i) == 0:
-        ValueError('Please enter the path to some vcf\'s following the -i flag')
+    if args.serve:
+        serve(args.serve, args.workers, args.protein_coding_genes, args.exon_bed, args.hgmd, args.hpo, args.exac, args.omim, args.biomart, args.gnomad, args.sv_counts, \
+            threads=args.threads, cache_dir=args.cache_dir, cache_size=args.cache_size, cluster_mode=args.cluster_mode, reference_bundle=args.reference_bundle, annotsv_cache=args.annotsv_cache)
+        parser.exit()
+
+    if args.report:
+        for report in args.report:
+            if len(report) < 3:
+                parser.error('-report takes a name, an output file and at least one vcf, got: %s' % ' '.join(report))
+        reports = [(report[0], report[1], report[2:]) for report in args.report]
+    elif args.i and args.o:
+        reports = [(args.o, args.o, args.i)]
     else:
-        main(args.protein_coding_genes, args.exon_bed, args.hgmd, args.hpo, args.exac, args.omim, args.biomart, args.gnomad, args.sv_counts, args.o, args.i)
+        parser.error('Please enter the path to some vcf\'s following the -i flag and an output file with -o, or use -report')
+
+    main(args.protein_coding_genes, args.exon_bed, args.hgmd, args.hpo, args.exac, args.omim, args.biomart, args.gnomad, args.sv_counts, reports, threads=args.threads, shard_by_chrom=args.shard_by_chrom, state=args.state, cache_dir=args.cache_dir, cache_size=args.cache_size, cluster_mode=args.cluster_mode, reference_bundle=args.reference_bundle, annotsv_cache=args.annotsv_cache, profile=args.profile)
@@ -16,9 +16,11 @@ HPO=${GENE_DATA}/HPO/${FAMILY}_HPO.txt
 EXAC=${GENE_DATA}/ExAC/fordist_cleaned_nonpsych_z_pli_rec_null_data.txt
 OMIM=${GENE_DATA}/OMIM_2020-04-09/genemap2.txt
 GNOMAD=${GENE_DATA}/gnomad_v2_sv.sites.bed
+GNOMAD_INDEX=${GENE_DATA}/gnomad_v2_sv.sites.npz
 BIOMART=${GENE_DATA}/BioMaRt.GrCh37.75.ensembl.mim.hgnc.entrez.txt
 MSSNG_MANTA_COUNTS=${GENE_DATA}/mssng_counts/Canadian_MSSNG_parent_SVs.Manta.counts.txt
 MSSNG_LUMPY_COUNTS=${GENE_DATA}/mssng_counts/Canadian_MSSNG_parent_SVs.LUMPY.counts.txt
+REFERENCE_BUNDLE=${GENE_DATA}/sv.reference.pkl
 
 if [ ! $2 ]; then
 	FAMILY=$1
@@ -52,23 +54,25 @@ do
 	tabix $FILE
 done
 
-#make filtered report
-echo "${PY} ${HOME}/crg/crg.intersect_sv_vcfs.py -protein_coding_genes=${PROTEIN_CODING_GENES} -exon_bed=${EXON_BED} -hgmd=${HGMD} -hpo=${HPO} -exac=${EXAC} -omim=${OMIM} -biomart=${BIOMART} -gnomad=${GNOMAD} -sv_counts ${MSSNG_MANTA_COUNTS} ${MSSNG_LUMPY_COUNTS} -o=${FAMILY}.wgs.sv.${TODAY}.tsv -i ${FILTERED_FILES}"
-${PY} ${HOME}/crg/crg.intersect_sv_vcfs.py -protein_coding_genes=${PROTEIN_CODING_GENES} -exon_bed=${EXON_BED} -hgmd=${HGMD} -hpo=${HPO} -exac=${EXAC} -omim=${OMIM} -biomart=${BIOMART} -gnomad=${GNOMAD} -sv_counts ${MSSNG_MANTA_COUNTS} ${MSSNG_LUMPY_COUNTS} -o=${FAMILY}.wgs.sv.${TODAY}.tsv -i ${FILTERED_FILES}
-
-${HOME}/crg/cap_report.py ${FAMILY}.wgs.sv.${TODAY}.tsv
-
-if [[ "$OSTYPE" == *"darwin"* ]]; then
-	open -a 'Microsoft Excel' ${FAMILY}.wgs.sv.${TODAY}.tsv
+#index HGMD, and build the gene reference annotations shared by all families and index gnomAD-SV when they are missing or older than their sources
+BUILD_ARGS="-hgmd=${HGMD}"
+if [ ! -f ${GNOMAD_INDEX} ] || [ ${GNOMAD} -nt ${GNOMAD_INDEX} ]; then
+	BUILD_ARGS="${BUILD_ARGS} -gnomad=${GNOMAD} -gnomad_index=${GNOMAD_INDEX}"
 fi
+if [ ! -f ${REFERENCE_BUNDLE} ] || [ ${EXAC} -nt ${REFERENCE_BUNDLE} ] || [ ${OMIM} -nt ${REFERENCE_BUNDLE} ] || [ ${BIOMART} -nt ${REFERENCE_BUNDLE} ]; then
+	BUILD_ARGS="${BUILD_ARGS} -exac=${EXAC} -omim=${OMIM} -biomart=${BIOMART} -o=${REFERENCE_BUNDLE}"
+fi
+${PY} ${HOME}/crg/crg.build_sv_reference.py ${BUILD_ARGS}
 
+#make filtered and unfiltered reports from one load of the reference data
+echo "${PY} ${HOME}/crg/crg.intersect_sv_vcfs.py -protein_coding_genes=${PROTEIN_CODING_GENES} -exon_bed=${EXON_BED} -hgmd=${HGMD} -hpo=${HPO} -exac=${EXAC} -omim=${OMIM} -biomart=${BIOMART} -gnomad=${GNOMAD_INDEX} -sv_counts ${MSSNG_MANTA_COUNTS} ${MSSNG_LUMPY_COUNTS} -reference_bundle=${REFERENCE_BUNDLE} -report filtered ${FAMILY}.wgs.sv.${TODAY}.tsv ${FILTERED_FILES} -report unfiltered ${FAMILY}.unfiltered.wgs.sv.${TODAY}.tsv ${IN_FILES}"
+${PY} ${HOME}/crg/crg.intersect_sv_vcfs.py -protein_coding_genes=${PROTEIN_CODING_GENES} -exon_bed=${EXON_BED} -hgmd=${HGMD} -hpo=${HPO} -exac=${EXAC} -omim=${OMIM} -biomart=${BIOMART} -gnomad=${GNOMAD_INDEX} -sv_counts ${MSSNG_MANTA_COUNTS} ${MSSNG_LUMPY_COUNTS} -reference_bundle=${REFERENCE_BUNDLE} -report filtered ${FAMILY}.wgs.sv.${TODAY}.tsv ${FILTERED_FILES} -report unfiltered ${FAMILY}.unfiltered.wgs.sv.${TODAY}.tsv ${IN_FILES}
 
-#make unfiltered report
-echo "${PY} ${HOME}/crg/crg.intersect_sv_vcfs.py -protein_coding_genes=${PROTEIN_CODING_GENES} -exon_bed=${EXON_BED} -hgmd=${HGMD} -hpo=${HPO} -exac=${EXAC} -omim=${OMIM} -biomart=${BIOMART} -gnomad=${GNOMAD} -sv_counts ${MSSNG_MANTA_COUNTS} ${MSSNG_LUMPY_COUNTS} -o=${FAMILY}.unfiltered.wgs.sv.${TODAY}.tsv -i ${IN_FILES}"
-${PY} ${HOME}/crg/crg.intersect_sv_vcfs.py -protein_coding_genes=${PROTEIN_CODING_GENES} -exon_bed=${EXON_BED} -hgmd=${HGMD} -hpo=${HPO} -exac=${EXAC} -omim=${OMIM} -biomart=${BIOMART} -gnomad=${GNOMAD} -sv_counts ${MSSNG_MANTA_COUNTS} ${MSSNG_LUMPY_COUNTS} -o=${FAMILY}.unfiltered.wgs.sv.${TODAY}.tsv -i ${IN_FILES}
-
-${HOME}/crg/cap_report.py ${FAMILY}.unfiltered.wgs.sv.${TODAY}.tsv
+for REPORT in ${FAMILY}.wgs.sv.${TODAY}.tsv ${FAMILY}.unfiltered.wgs.sv.${TODAY}.tsv
+do
+	${HOME}/crg/cap_report.py ${REPORT}
 
-if [[ "$OSTYPE" == *"darwin"* ]]; then
-	open -a 'Microsoft Excel' ${FAMILY}.unfiltered.wgs.sv.${TODAY}.tsv
-fi
+	if [[ "$OSTYPE" == *"darwin"* ]]; then
+		open -a 'Microsoft Excel' ${REPORT}
+	fi
+done
@@ -0,0 +1,39 @@
+import argparse
+import json
+import os
+import socket
+import sys
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sends a structural variant report job to a worker started with crg.intersect_sv_vcfs.py -serve, and waits for its reports to be written')
+    parser.add_argument('-socket', help='Unix socket the worker listens on', type=str, required=True)
+    parser.add_argument('-i', type=str, nargs='+', help='VCF files containing structural variants, e.g. -i 180_230.vcf 180_231.vcf')
+    parser.add_argument('-o', help='Output file name e.g. -o 180.sv.family.tsv', type=str)
+    parser.add_argument('-report', nargs='+', action='append', metavar='NAME OUTPUT VCF', help='Name, output file and VCF files of a report, instead of -i and -o. Repeat to make several reports in one job')
+    parser.add_argument('-hpo', help='Tab delimited file containing gene names and HPO terms, replaces the one the worker was started with', type=str)
+    args = parser.parse_args()
+
+    if args.report:
+        for report in args.report:
+            if len(report) < 3:
+                parser.error('-report takes a name, an output file and at least one vcf, got: %s' % ' '.join(report))
+        reports = [(report[0], report[1], report[2:]) for report in args.report]
+    elif args.i and args.o:
+        reports = [(args.o, args.o, args.i)]
+    else:
+        parser.error('Please enter the path to some vcf\'s following the -i flag and an output file with -o, or use -report')
+
+    # the worker runs in another directory, so send absolute paths
+    job = {'reports': [(name, os.path.abspath(outfile_name), [os.path.abspath(vcf) for vcf in vcfs]) for name, outfile_name, vcfs in reports]}
+    if args.hpo:
+        job['hpo'] = os.path.abspath(args.hpo)
+
+    with socket.socket(socket.AF_UNIX) as client:
+        client.connect(args.socket)
+        client.sendall((json.dumps(job) + '\n').encode())
+        response = json.loads(client.makefile().readline())
+
+    if response['status'] != 'done':
+        print(response.get('error', response), file=sys.stderr)
+        sys.exit(1)
+    print('Wrote %s' % ', '.join(outfile_name for name, outfile_name, vcfs in job['reports']))
@@ -3,11 +3,13 @@ import pandas as pd
 import os
 import argparse
 from pybedtools import BedTool
+from SVRecords.compact import pooled_categoricals
+from SVRecords.overlap import intersect_intervals
 
 class CNVGrouper:
     def __init__(self, reports):
-        def list2string(col):
-            return col.apply(lambda x: ', '.join(x) if isinstance(x, list) else x)
+        def list2string(x):
+            return ', '.join(x) if isinstance(x, list) else x
 
         #key - dataframe col name : value - vcf field name
         self.index_cols = ['CHROM', 'START', 'END', 'SVTYPE']
@@ -24,18 +26,23 @@ class CNVGrouper:
         self._group_sv(all_sv)
         self.bedtool = self.make_ref_bedtool()
 
+        # keep the grouped columns compact: small integer flags and details pooled in to one set of categories
+        self.df['N_SAMPLES'] = self.df['N_SAMPLES'].astype(np.uint16)
         for name in self.sample_list:
-            self.df["%s_SV_DETAILS" % name] = list2string(self.df["%s_SV_DETAILS" % name])
+            self.df[name] = self.df[name].astype(np.uint8)
+        details = pooled_categoricals({"%s_SV_DETAILS" % name: [list2string(x) if x else None for x in self.df["%s_SV_DETAILS" % name]] for name in self.sample_list})
+        for col, values in details.items():
+            self.df[col] = values
 
         # append annotation fields to final df
         self.df = self.df.join(ann_df, how='left')
 
     def _parse_reports(self, report_paths):
         '''
-            Merge all SV interval data from multiple vcf's in to a single BedTool instance
+            Merge all SV interval data from multiple vcf's in to a single list of intervals
 
             Implementation:
-                Use Panda's dataframe for some easy preprocessing, then create a BedTool from a tuple containing each row
+                Use Panda's dataframe for some easy preprocessing, then collect a tuple containing each row
         '''
 
         intervals = []
@@ -57,12 +64,12 @@ class CNVGrouper:
         ann_df = pd.concat(ann_dfs).astype(str).set_index(self.index_cols)
         ann_df = ann_df[~ann_df.index.duplicated(keep='first')] #annotations for the same SV in a vcf can have slighly differing fields (ex. SVSCORE_MEAN)
 
-        return BedTool(intervals), ann_df, sample_names
+        return intervals, ann_df, sample_names
 
-    def _group_sv(self, bedtool, reciprocal_overlap=0.5):
+    def _group_sv(self, intervals, reciprocal_overlap=0.5):
         already_grouped_intervals = set()
 
-        for l in bedtool.intersect(bedtool, wa=True, wb=True, F=reciprocal_overlap, f=reciprocal_overlap):
+        for l in intersect_intervals(intervals, reciprocal_overlap=reciprocal_overlap):
 
             ref_chr, ref_start, ref_end, ref_svtype, ref_name, \
             samp_chr, samp_start, samp_end, samp_svtype, samp_name = l